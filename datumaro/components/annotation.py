@@ -346,12 +346,16 @@ class CompiledMask:
           By default, mask positions are used.
         - instance_labels - Instance label id values for the produced class
           mask. By default, mask labels are used.
+
+        The id values can also be passed as numpy arrays.
         """
 
         from datumaro.util.mask_tools import make_index_mask
 
-        instance_ids = instance_ids or []
-        instance_labels = instance_labels or []
+        if instance_ids is None:
+            instance_ids = []
+        if instance_labels is None:
+            instance_labels = []
         masks = sorted(
             zip_longest(instance_masks, instance_ids, instance_labels),
             key=lambda m: m[0].z_order)
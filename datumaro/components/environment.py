@@ -14,7 +14,7 @@ import os.path as osp
 
 from datumaro.components.cli_plugin import CliPlugin, plugin_types
 from datumaro.components.format_detection import (
-    FormatRequirementsUnmet, apply_format_detector,
+    DetectionSession, FormatRequirementsUnmet, apply_format_detector,
 )
 from datumaro.util.os_util import import_foreign_module, split_path
 
@@ -235,10 +235,13 @@ class Environment:
         max_confidence = 0
         matches = []
 
+        session = DetectionSession(path)
+
         for format_name, importer in self.importers.items.items():
             log.debug("Checking '%s' format...", format_name)
             try:
-                new_confidence = apply_format_detector(path, importer.detect)
+                new_confidence = apply_format_detector(path, importer.detect,
+                    session=session)
             except FormatRequirementsUnmet as cf:
                 log.debug("Format did not match")
                 if len(cf.failed_alternatives) > 1:
@@ -2,14 +2,22 @@
 #
 # SPDX-License-Identifier: MIT
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from enum import IntEnum
 from typing import (
-    Callable, Collection, Iterator, List, Optional, Sequence, TextIO, Union,
+    Callable, Collection, Dict, Iterator, List, Mapping, Match, Optional,
+    Pattern, Sequence, TextIO, Tuple, Union,
 )
 import contextlib
 import fnmatch
+import functools
 import glob
+import os
 import os.path as osp
+import re
+import stat
+import threading
 
 from typing_extensions import NoReturn
 
@@ -58,7 +66,323 @@ class FormatRequirementsUnmet(Exception):
 
     def __init__(self, failed_alternatives: Sequence[str]) -> None:
         assert failed_alternatives
-        self.failed_alternatives = tuple(failed_alternatives)
+        self._failed_alternatives = tuple(failed_alternatives)
+
+    @classmethod
+    def _from_list(cls,
+            failed_alternatives: Sequence[str]) -> 'FormatRequirementsUnmet':
+        """
+        Creates an instance without copying `failed_alternatives`.
+        The caller must not modify the sequence afterwards.
+        """
+
+        instance = cls.__new__(cls)
+        # Set the same args as __init__ would, so that the instance can be
+        # printed and pickled like the ones created by the constructor
+        Exception.__init__(instance, failed_alternatives)
+        instance._failed_alternatives = failed_alternatives
+        return instance
+
+    @property
+    def failed_alternatives(self) -> Tuple[str, ...]:
+        if not isinstance(self._failed_alternatives, tuple):
+            self._failed_alternatives = tuple(self._failed_alternatives)
+        return self._failed_alternatives
+
+def _list_dir(path: str) -> List[os.DirEntry]:
+    """
+    Returns the entries of the directory at `path`.
+    Raises OSError if the directory can't be listed.
+    """
+
+    with os.scandir(path) as it:
+        return list(it)
+
+# On case-insensitive platforms, names are matched case-insensitively, like
+# fnmatch does. Using a regex flag avoids normalizing each name.
+_NAME_RE_FLAGS = 0 if osp.normcase('A') == 'A' else re.IGNORECASE
+
+@functools.lru_cache(maxsize=512)
+def _compile_segment(segment: str) -> Callable[[str], Optional[Match]]:
+    """
+    Returns a function that checks whether a file name matches
+    a wildcard pattern segment.
+    """
+
+    return re.compile(fnmatch.translate(segment), _NAME_RE_FLAGS).match
+
+# Names of directories that are not searched for dataset files by default.
+# These are typically created by version control systems and other tools,
+# and can contain lots of irrelevant files.
+DEFAULT_PRUNED_DIRS = frozenset({
+    '.git', '.hg', '.svn', '.ipynb_checkpoints', '__pycache__', 'node_modules',
+})
+
+def _get_dir_id(path: str) -> Optional[Tuple[int, int]]:
+    """
+    Returns a pair of numbers that identifies the directory at `path`,
+    with symlinks resolved, or None if the directory can't be accessed.
+    """
+
+    # DirEntry.stat() can't be used here, because it doesn't provide
+    # the device and inode numbers on Windows
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino)
+
+def _iter_pattern_matches(root: str,
+    segments: Sequence[Tuple[str, bool]], *,
+    list_dir: Callable[[str], List[os.DirEntry]] = _list_dir,
+    prune_dirs: Collection[str] = frozenset(),
+) -> Iterator[str]:
+    """
+    Yields paths of files within `root` that match the glob pattern
+    represented by `segments` (as returned by `_decompose_pattern`).
+
+    Follows the semantics of `glob.glob(..., recursive=True)`, but only
+    enumerates directories whose names match the corresponding pattern
+    segment, so the matches can be produced lazily and cheaply.
+
+    Entry types are only queried for entries with matching names. DirEntry
+    methods reuse the type information returned when listing the directory,
+    so this normally doesn't require any stat calls.
+
+    Directories with names from `prune_dirs` are not matched by wildcards.
+    """
+
+    if not segments:
+        return
+
+    (segment, has_magic), rest = segments[0], segments[1:]
+
+    if not has_magic:
+        path = osp.join(root, segment)
+        if rest:
+            yield from _iter_pattern_matches(path, rest, list_dir=list_dir,
+                prune_dirs=prune_dirs)
+        elif osp.isfile(path):
+            yield path
+        return
+
+    if segment == '**':
+        # '**' matches zero or more subdirectories. As the last segment,
+        # it matches all the files in the subtree. The subtree is traversed
+        # with an explicit stack, so that the traversal can stop as soon as
+        # the consumer is satisfied, and deep trees don't hit
+        # the recursion limit.
+        #
+        # Like glob, symlinks to directories are followed. The visited
+        # directories are tracked by their device and inode numbers,
+        # so that symlink loops are not traversed infinitely.
+        visited_dirs = set()
+        dir_id = _get_dir_id(root)
+        if dir_id is not None:
+            visited_dirs.add(dir_id)
+
+        dir_stack = [root]
+        while dir_stack:
+            dir_path = dir_stack.pop()
+
+            if rest:
+                yield from _iter_pattern_matches(dir_path, rest,
+                    list_dir=list_dir, prune_dirs=prune_dirs)
+
+            try:
+                entries = list_dir(dir_path)
+            except OSError:
+                continue
+
+            for entry in entries:
+                # like glob, skip hidden files and directories
+                if entry.name.startswith('.'):
+                    continue
+
+                if entry.is_dir():
+                    if entry.name in prune_dirs:
+                        continue
+
+                    dir_id = _get_dir_id(entry.path)
+                    if dir_id is None or dir_id in visited_dirs:
+                        continue
+                    visited_dirs.add(dir_id)
+
+                    dir_stack.append(entry.path)
+                elif not rest and entry.is_file():
+                    yield entry.path
+        return
+
+    try:
+        entries = list_dir(root)
+    except OSError:
+        return
+
+    match_name = _compile_segment(segment)
+    match_hidden = segment.startswith('.')
+
+    for entry in entries:
+        if entry.name.startswith('.') and not match_hidden:
+            continue
+
+        if not match_name(entry.name):
+            continue
+
+        if rest:
+            if entry.name not in prune_dirs and entry.is_dir():
+                yield from _iter_pattern_matches(entry.path, rest,
+                    list_dir=list_dir, prune_dirs=prune_dirs)
+        elif entry.is_file():
+            yield entry.path
+
+@functools.lru_cache(maxsize=256)
+def _compile_excludes(patterns: Sequence[str]) -> Optional[Pattern]:
+    """
+    Combines file name patterns into a single regular expression
+    that matches any name matched by at least one of the patterns.
+    """
+
+    if not patterns:
+        return None
+
+    return re.compile('|'.join(f'(?:{fnmatch.translate(p)})'
+        for p in patterns), _NAME_RE_FLAGS)
+
+@functools.lru_cache(maxsize=512)
+def _decompose_pattern(pattern: str) -> Tuple[Tuple[str, bool], ...]:
+    """
+    Splits a glob pattern on path separators. Returns the non-trivial segments
+    along with flags that tell whether each segment contains wildcards.
+    """
+
+    if osp.altsep:
+        pattern = pattern.replace(osp.altsep, osp.sep)
+
+    if pattern.endswith(osp.sep):
+        # like glob, such a pattern can only match directories
+        return ()
+
+    return tuple((s, glob.has_magic(s))
+        for s in pattern.split(osp.sep) if s and s != '.')
+
+class DetectionSession:
+    """
+    Holds the information about a dataset that can be shared between
+    several format detectors applied to it, so that the same filesystem
+    queries are not repeated for every detector.
+
+    A session is supposed to be short-lived: the dataset must not be modified
+    while it is in use. A session can be used from several threads
+    at once.
+    """
+
+    root_path: str
+    root_stat: Optional[os.stat_result]
+    root_is_dir: bool
+
+    # Names of directories that are skipped when searching for files
+    prune_dirs: Collection[str]
+
+    # Maps (pattern, exclude_fnames) to the result of a `require_file` call.
+    # `None` means that no matching file was found.
+    file_cache: Dict[Tuple[str, Tuple[str, ...]], Optional[str]]
+
+    # Maps directory paths to their modification times and contents.
+    # The least recently used entries are at the beginning.
+    _dir_cache: 'OrderedDict[str, Tuple[int, List[os.DirEntry]]]'
+
+    _DIR_CACHE_SIZE = 1024
+
+    def __init__(self, root_path: str, *,
+        prune_dirs: Collection[str] = DEFAULT_PRUNED_DIRS,
+    ) -> None:
+        self.root_path = root_path
+        self.prune_dirs = frozenset(prune_dirs)
+
+        try:
+            self.root_stat = os.stat(root_path)
+        except OSError:
+            self.root_stat = None
+        self.root_is_dir = self.root_stat is not None and \
+            stat.S_ISDIR(self.root_stat.st_mode)
+        self.file_cache = {}
+        self._dir_cache = OrderedDict()
+        self._dir_cache_lock = threading.Lock()
+
+    def _list_dir(self, path: str) -> List[os.DirEntry]:
+        """
+        Same as the module-level `_list_dir`, but reuses the previous
+        listing of the directory if it hasn't been modified since.
+        """
+
+        mtime = os.stat(path).st_mtime_ns
+
+        with self._dir_cache_lock:
+            cached = self._dir_cache.get(path)
+            if cached is not None and cached[0] == mtime:
+                self._dir_cache.move_to_end(path)
+                return cached[1]
+
+        entries = _list_dir(path)
+
+        with self._dir_cache_lock:
+            self._dir_cache[path] = (mtime, entries)
+            self._dir_cache.move_to_end(path)
+            if len(self._dir_cache) > self._DIR_CACHE_SIZE:
+                self._dir_cache.popitem(last=False)
+
+        return entries
+
+_PARENT_DIR_PREFIX = osp.pardir + osp.sep
+
+_PROBE_BUFFER_SIZE = 64 * 1024
+
+def _open_text_file(path: str) -> TextIO:
+    """
+    Opens a file for reading as UTF-8 text. Avoids updating the access time
+    of the file, where the platform allows this.
+    """
+
+    flags = os.O_RDONLY | getattr(os, 'O_BINARY', 0) | \
+        getattr(os, 'O_CLOEXEC', 0)
+
+    fd = None
+
+    noatime_flag = getattr(os, 'O_NOATIME', 0)
+    if noatime_flag:
+        try:
+            fd = os.open(path, flags | noatime_flag)
+        except PermissionError:
+            # O_NOATIME is only allowed for the owner of the file
+            pass
+
+    if fd is None:
+        fd = os.open(path, flags)
+
+    try:
+        return os.fdopen(fd, 'r', buffering=_PROBE_BUFFER_SIZE,
+            encoding='utf-8')
+    except BaseException:
+        os.close(fd)
+        raise
+
+class _SkipAlternatives(Exception):
+    pass
+
+class _AlternativeRequirementUnmet(FormatRequirementsUnmet):
+    """
+    A cheaper variant of `FormatRequirementsUnmet` for requirements that fail
+    within `alternative` blocks. Such exceptions are always caught
+    by `alternative`, which only needs the single failure description.
+    """
+
+    def __init__(self, requirement_desc: str) -> None:
+        # pylint: disable=super-init-not-called
+        self.requirement_desc = requirement_desc
+
+    @property
+    def failed_alternatives(self) -> Tuple[str, ...]:
+        return (self.requirement_desc,)
 
 class FormatDetectionContext:
     """
@@ -74,20 +398,59 @@ class FormatDetectionContext:
     """
 
     class _OneOrMoreContext:
+        __slots__ = ('failed_alternatives', 'had_successful_alternatives',
+            'short_circuit')
+
         failed_alternatives: List[str]
         had_successful_alternatives: bool
+        short_circuit: bool
 
         def __init__(self) -> None:
             self.failed_alternatives = []
             self.had_successful_alternatives = False
+            self.short_circuit = False
+
+    __slots__ = ('_root_path', '_one_or_more_context', '_in_alternative',
+        '_session', '_root_is_dir', '_list_dir', '_prune_dirs')
 
     # This points to a `_OneOrMoreContext` when and only when the detector
     # is directly within a `require_any` block.
     _one_or_more_context: Optional[_OneOrMoreContext]
 
-    def __init__(self, root_path: str) -> None:
+    # This is True when the detector is within an `alternative` block
+    # (possibly, indirectly).
+    _in_alternative: bool
+
+    _session: Optional[DetectionSession]
+    _root_is_dir: bool
+    _list_dir: Callable[[str], List[os.DirEntry]]
+    _prune_dirs: Collection[str]
+
+    def __init__(self, root_path: str, *,
+        session: Optional[DetectionSession] = None,
+        prune_dirs: Optional[Collection[str]] = None,
+    ) -> None:
+        assert session is None or session.root_path == root_path
+        assert session is None or prune_dirs is None, \
+            "prune_dirs must be specified for the session instead"
+
         self._root_path = root_path
         self._one_or_more_context = None
+        self._in_alternative = False
+        self._session = session
+
+        # Resolve the session-dependent parts once, since they're needed
+        # by every requirement.
+        if session is not None:
+            self._root_is_dir = session.root_is_dir
+            self._list_dir = session._list_dir
+            self._prune_dirs = session.prune_dirs
+        else:
+            self._root_is_dir = osp.isdir(root_path)
+            self._list_dir = _list_dir
+            if prune_dirs is None:
+                prune_dirs = DEFAULT_PRUNED_DIRS
+            self._prune_dirs = frozenset(prune_dirs)
 
     @property
     def root_path(self) -> str:
@@ -114,15 +477,15 @@ class FormatDetectionContext:
             return False
 
         path = osp.normpath(path)
-        if path.startswith('..' + osp.sep):
+        if path == osp.pardir or path.startswith(_PARENT_DIR_PREFIX):
             return False
 
         return True
 
     def _start_requirement(self, req_type: str) -> None:
-        assert not self._one_or_more_context, \
-            f"a requirement ({req_type}) can't be placed directly within " \
-            "a 'require_any' block"
+        if self._one_or_more_context is not None:
+            raise AssertionError(f"a requirement ({req_type}) can't be "
+                "placed directly within a 'require_any' block")
 
     def fail(self, requirement_desc: str) -> NoReturn:
         """
@@ -131,7 +494,10 @@ class FormatDetectionContext:
         """
         self._start_requirement("fail")
 
-        raise FormatRequirementsUnmet((requirement_desc,))
+        if self._in_alternative:
+            raise _AlternativeRequirementUnmet(requirement_desc)
+
+        raise FormatRequirementsUnmet._from_list((requirement_desc,))
 
     def require_file(self, pattern: str, *,
         exclude_fnames: Union[str, Collection[str]] = (),
@@ -168,21 +534,59 @@ class FormatDetectionContext:
         if not self._is_path_within_root(pattern):
             self.fail(requirement_desc)
 
-        pattern_abs = osp.join(glob.escape(self._root_path), pattern)
-        for path in glob.iglob(pattern_abs, recursive=True):
-            if osp.isfile(path):
-                # Ideally, we should provide a way to filter out whole paths,
-                # not just file names. However, there is no easy way to match an
-                # entire path with a pattern (fnmatch is unsuitable, because
-                # it lets '*' match a slash, which can lead to spurious matches
-                # and is not how glob works).
-                if any(fnmatch.fnmatch(osp.basename(path), pat)
-                        for pat in exclude_fnames):
-                    continue
+        if self._session is not None:
+            cache_key = (pattern, tuple(exclude_fnames))
+            try:
+                result = self._session.file_cache[cache_key]
+            except KeyError:
+                result = self._find_file(pattern, exclude_fnames)
+                self._session.file_cache[cache_key] = result
+        else:
+            result = self._find_file(pattern, exclude_fnames)
+
+        if result is None:
+            self.fail(requirement_desc)
+
+        return result
+
+    def _find_file(self, pattern: str,
+            exclude_fnames: Collection[str]) -> Optional[str]:
+        # Ideally, we should provide a way to filter out whole paths,
+        # not just file names. However, there is no easy way to match an
+        # entire path with a pattern (fnmatch is unsuitable, because
+        # it lets '*' match a slash, which can lead to spurious matches
+        # and is not how glob works).
+        exclude_re = _compile_excludes(tuple(exclude_fnames))
+
+        segments = _decompose_pattern(pattern)
+
+        # The leading segments without wildcards denote a single directory,
+        # so there is no need to search for it.
+        literal_count = next(
+            (i for i, (_, has_magic) in enumerate(segments) if has_magic),
+            len(segments))
+        search_root = osp.join(self._root_path,
+            *(s for s, _ in segments[:literal_count]))
+
+        if literal_count == len(segments):
+            if not osp.isfile(search_root):
+                return None
+            candidates = [search_root]
+        elif not osp.isdir(search_root):
+            return None
+        else:
+            candidates = _iter_pattern_matches(search_root,
+                segments[literal_count:], list_dir=self._list_dir,
+                prune_dirs=self._prune_dirs)
 
-                return osp.relpath(path, self._root_path)
+        for path in candidates:
+            if exclude_re is not None and \
+                    exclude_re.match(osp.basename(path)):
+                continue
 
-        self.fail(requirement_desc)
+            return osp.relpath(path, self._root_path)
+
+        return None
 
     @contextlib.contextmanager
     def probe_text_file(
@@ -220,7 +624,7 @@ class FormatDetectionContext:
             self.fail(requirement_desc_full)
 
         try:
-            with open(osp.join(self._root_path, path), encoding='utf-8') as f:
+            with _open_text_file(osp.join(self._root_path, path)) as f:
                 yield f
         except FormatRequirementsUnmet:
             raise
@@ -228,7 +632,51 @@ class FormatDetectionContext:
             self.fail(requirement_desc_full)
 
     @contextlib.contextmanager
-    def require_any(self) -> Iterator[None]:
+    def probe_binary_header(
+        self, path: str, n_bytes: int, requirement_desc: str,
+    ) -> Iterator[bytes]:
+        """
+        Returns a context manager that can be used to place a requirement on
+        the first bytes of the file referred to by `path`, such as a magic
+        number. On entering, up to `n_bytes` bytes are read from the beginning
+        of the file and returned. The file is not decoded, and the rest of
+        it is not read.
+
+        The requirement that is placed by doing this is considered met if all
+        of the following are true:
+
+        * `path` is a relative path that refers to a file within the dataset
+          root.
+        * The file is read successfully.
+        * The context is exited without an exception.
+
+        If the context is exited with an exception that was produced by another
+        requirement being unmet, that exception is reraised and the new
+        requirement is abandoned.
+
+        `requirement_desc` must be a human-readable statement describing the
+        requirement.
+        """
+
+        self._start_requirement("probe_binary_header")
+
+        requirement_desc_full = f"{path}: {requirement_desc}"
+
+        if not self._is_path_within_root(path):
+            self.fail(requirement_desc_full)
+
+        try:
+            with open(osp.join(self._root_path, path), 'rb') as f:
+                header = f.read(n_bytes)
+
+            yield header
+        except FormatRequirementsUnmet:
+            raise
+        except Exception:
+            self.fail(requirement_desc_full)
+
+    @contextlib.contextmanager
+    def require_any(self, *, short_circuit: bool = False) -> Iterator[None]:
         """
         Returns a context manager that can be used to place a requirement that
         is considered met if at least one of several alternative sets of
@@ -244,8 +692,12 @@ class FormatDetectionContext:
                     # place requirements from alternative set 2 here
                 ...
 
-        The contents of all `with context.alternative()` blocks will be
-        executed, even if an alternative that is met is found early.
+        By default, the contents of all `with context.alternative()` blocks
+        will be executed, even if an alternative that is met is found early.
+        If `short_circuit` is True, the rest of the `require_any` block
+        is skipped as soon as an alternative is met. This avoids the work of
+        checking the remaining alternatives, so it should be used when
+        the detector doesn't rely on the side effects of those blocks.
 
         Requirements must not be placed directly within a
         `with context.require_any()` block.
@@ -254,9 +706,13 @@ class FormatDetectionContext:
         self._start_requirement("require_any")
 
         self._one_or_more_context = self._OneOrMoreContext()
+        self._one_or_more_context.short_circuit = short_circuit
 
         try:
-            yield
+            try:
+                yield
+            except _SkipAlternatives:
+                pass
 
             # If at least one `alternative` block succeeded,
             # then the `require_any` block succeeds.
@@ -269,7 +725,7 @@ class FormatDetectionContext:
                 "a 'require_any' block must contain " \
                 "at least one 'alternative' block"
 
-            raise FormatRequirementsUnmet(
+            raise FormatRequirementsUnmet._from_list(
                 self._one_or_more_context.failed_alternatives)
         finally:
             self._one_or_more_context = None
@@ -288,11 +744,21 @@ class FormatDetectionContext:
             "An 'alternative' block must be directly within " \
             "a 'require_any' block"
 
+        if self._one_or_more_context.short_circuit and \
+                self._one_or_more_context.had_successful_alternatives:
+            # Skips the rest of the enclosing 'require_any' block
+            raise _SkipAlternatives
+
         saved_one_or_more_context = self._one_or_more_context
+        saved_in_alternative = self._in_alternative
         self._one_or_more_context = None
+        self._in_alternative = True
 
         try:
             yield
+        except _AlternativeRequirementUnmet as e:
+            saved_one_or_more_context.failed_alternatives.append(
+                e.requirement_desc)
         except FormatRequirementsUnmet as e:
             saved_one_or_more_context.failed_alternatives.extend(
                 e.failed_alternatives)
@@ -300,6 +766,7 @@ class FormatDetectionContext:
             saved_one_or_more_context.had_successful_alternatives = True
         finally:
             self._one_or_more_context = saved_one_or_more_context
+            self._in_alternative = saved_in_alternative
 
 
 FormatDetector = Callable[
@@ -319,16 +786,74 @@ the `FormatDetectionContext` methods.
 """
 
 def apply_format_detector(
-    dataset_root_path: str, detector: FormatDetector,
+    dataset_root_path: str, detector: FormatDetector, *,
+    session: Optional[DetectionSession] = None,
+    prune_dirs: Optional[Collection[str]] = None,
 ) -> FormatDetectionConfidence:
     """
     Checks whether the dataset located at `dataset_root_path` belongs to the
     format detected by `detector`. If it does, returns the confidence level
     of the detection. Otherwise, raises a `FormatRequirementsUnmet` exception.
+
+    If several detectors are applied to the same dataset, a `DetectionSession`
+    for it can be passed in `session` to share the filesystem queries
+    between them.
+
+    `prune_dirs` is the collection of names of directories that must not be
+    searched for files (`DEFAULT_PRUNED_DIRS` by default). If a session is
+    used, this must be specified when creating the session instead.
     """
-    context = FormatDetectionContext(dataset_root_path)
+    context = FormatDetectionContext(dataset_root_path, session=session,
+        prune_dirs=prune_dirs)
 
-    if not osp.isdir(dataset_root_path):
+    if not context._root_is_dir:
         context.fail(f"root path {dataset_root_path} must refer to a directory")
 
     return detector(context) or FormatDetectionConfidence.MEDIUM
+
+def apply_format_detectors(
+    dataset_root_path: str, detectors: Mapping[str, FormatDetector], *,
+    max_workers: int = 1,
+    prune_dirs: Collection[str] = DEFAULT_PRUNED_DIRS,
+) -> Dict[str, Union[FormatDetectionConfidence, FormatRequirementsUnmet]]:
+    """
+    Applies each of `detectors` to the dataset located at `dataset_root_path`,
+    like `apply_format_detector` does. The detectors share
+    a `DetectionSession`.
+
+    By default, the detectors are applied one by one, in order.
+    If `max_workers` is greater than 1, they are applied concurrently
+    in up to `max_workers` threads. This is only safe if the detectors
+    don't share any state.
+
+    Returns a dictionary that maps each detector name to either the confidence
+    level of the detection or the `FormatRequirementsUnmet` exception
+    raised by the detector. The dictionary has the same order as `detectors`.
+    """
+
+    assert 0 < max_workers, max_workers
+
+    if not detectors:
+        return {}
+
+    session = DetectionSession(dataset_root_path, prune_dirs=prune_dirs)
+
+    def _apply(detector):
+        try:
+            return apply_format_detector(dataset_root_path, detector,
+                session=session)
+        except FormatRequirementsUnmet as e:
+            return e
+
+    max_workers = min(max_workers, len(detectors))
+    if max_workers == 1:
+        return { name: _apply(detector)
+            for name, detector in detectors.items() }
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            name: executor.submit(_apply, detector)
+            for name, detector in detectors.items()
+        }
+
+        return { name: f.result() for name, f in futures.items() }
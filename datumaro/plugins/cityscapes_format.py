@@ -2,7 +2,8 @@
 #
 # SPDX-License-Identifier: MIT
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, auto
 import logging as log
 import os
@@ -18,8 +19,15 @@ from datumaro.components.dataset import ItemStatus
 from datumaro.components.extractor import DatasetItem, Importer, SourceExtractor
 from datumaro.util import find
 from datumaro.util.annotation_util import make_label_id_mapping
-from datumaro.util.image import find_images, load_image, save_image
+from datumaro.util.image import IMAGE_EXTENSIONS, load_image, save_image
 from datumaro.util.mask_tools import generate_colormap, paint_mask
+from datumaro.util.os_util import DEFAULT_MAX_DEPTH
+
+try:
+    # An optional fast PNG decoder
+    import pyspng
+except ImportError:
+    pyspng = None
 
 CityscapesLabelMap = OrderedDict([
     ('unlabeled', (0, 0, 0)),
@@ -69,8 +77,20 @@ class CityscapesPath:
     COLOR_IMAGE = '_color.png'
     LABELIDS_IMAGE = '_labelIds.png'
 
+    # A non-standard file with the class and instance masks of an item,
+    # which is much faster to read than the PNG masks
+    MASKS_ARCHIVE = '_masks.npz'
+    GT_MASKS_ARCHIVE_SUFFIX = '_' + GT_FINE_DIR + MASKS_ARCHIVE
+
     LABELMAP_FILE = 'label_colors.txt'
 
+    MASK_CACHE_DIR = osp.join('.datumaro_cache', 'cityscapes')
+    MASK_CACHE_EXT = '.npy'
+
+# The environment variable that sets the number of threads used to decode
+# masks during import. Set it to 1 to decode masks in the calling thread.
+NUM_DECODE_THREADS_ENV_VAR = 'DATUMARO_NUM_DECODE_THREADS'
+
 def make_cityscapes_categories(label_map=None):
     if label_map is None:
         label_map = CityscapesLabelMap
@@ -97,9 +117,10 @@ def make_cityscapes_categories(label_map=None):
     if not has_colors: # generate new colors
         colormap = generate_colormap(len(label_map))
     else: # only copy defined colors
-        label_id = lambda label: label_categories.find(label)[0]
-        colormap = { label_id(name): (desc[0], desc[1], desc[2])
-            for name, desc in label_map.items() }
+        # labels are added in the label map order, so label ids
+        # are just the positions in the map
+        colormap = { label_id: (desc[0], desc[1], desc[2])
+            for label_id, desc in enumerate(label_map.values()) }
     mask_categories = MaskCategories(colormap)
     mask_categories.inverse_colormap # pylint: disable=pointless-statement
     categories[AnnotationType.mask] = mask_categories
@@ -109,28 +130,29 @@ def parse_label_map(path):
     if not path:
         return None
 
-    label_map = OrderedDict()
     with open(path, 'r', encoding='utf-8') as f:
-        for line in f:
-            # skip empty and commented lines
-            line = line.strip()
-            if not line or line and line[0] == '#':
-                continue
+        lines = f.read().splitlines()
+
+    label_map = OrderedDict()
+    for line in lines:
+        # color, name
+        label_desc = line.split()
 
-            # color, name
-            label_desc = line.strip().split()
+        # skip empty and commented lines
+        if not label_desc or label_desc[0][0] == '#':
+            continue
 
-            if 2 < len(label_desc):
-                name = label_desc[3]
-                color = tuple([int(c) for c in label_desc[:-1]])
-            else:
-                name = label_desc[0]
-                color = None
+        if 2 < len(label_desc):
+            name = label_desc[3]
+            color = tuple(map(int, label_desc[:-1]))
+        else:
+            name = label_desc[0]
+            color = None
 
-            if name in label_map:
-                raise ValueError("Label '%s' is already defined" % name)
+        if name in label_map:
+            raise ValueError("Label '%s' is already defined" % name)
 
-            label_map[name] = color
+        label_map[name] = color
     return label_map
 
 def write_label_map(path, label_map):
@@ -142,8 +164,107 @@ def write_label_map(path, label_map):
                 color_rgb = ''
             f.write('%s %s\n' % (color_rgb, label_name))
 
+def _load_instance_mask(path):
+    """
+    Reads a single-channel instance id mask. If pyspng is available, it is used
+    to decode the image, which is considerably faster than the generic
+    image loaders.
+
+    Instance ids are stored in 16-bit PNG files, so the mask is returned
+    as an uint16 array (or uint8, if the file is 8-bit), which is half
+    the size of an int32 one.
+    """
+
+    if path.endswith(CityscapesPath.MASKS_ARCHIVE):
+        with np.load(path, allow_pickle=False) as masks:
+            return masks['instance_mask']
+
+    if pyspng is not None and path.lower().endswith('.png'):
+        with open(path, 'rb') as f:
+            mask = pyspng.load(f.read())
+
+        if mask.ndim == 3 and mask.shape[2] == 2:
+            mask = mask[:, :, 0] # drop the alpha channel
+
+        if mask.ndim == 2:
+            return mask
+
+    return load_image(path, dtype=np.uint16)
+
+def _get_decode_thread_count():
+    value = os.environ.get(NUM_DECODE_THREADS_ENV_VAR)
+    if value:
+        try:
+            return max(1, int(value))
+        except ValueError:
+            log.warning("Ignoring invalid value of %s: '%s'",
+                NUM_DECODE_THREADS_ENV_VAR, value)
+
+    return os.cpu_count() or 1
+
+def _load_instance_masks(paths, load_mask=_load_instance_mask):
+    """
+    Yields the (path, mask) pairs for the mask paths given, in the same order.
+    PNG decoding releases the GIL, so the masks are decoded in a thread pool.
+    """
+
+    num_threads = min(_get_decode_thread_count(), len(paths))
+    if num_threads <= 1:
+        yield from zip(paths, map(load_mask, paths))
+        return
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        yield from zip(paths, executor.map(load_mask, paths))
+
+def _find_files(dir_path, name_filter):
+    """
+    Returns the paths of the files found recursively in the directory,
+    for which `name_filter(filename)` is True.
+
+    Like os.walk(), but uses the DirEntry objects directly, so that
+    the only call per directory is one scandir.
+    """
+
+    paths = []
+
+    dir_stack = [(dir_path, 0)]
+    while dir_stack:
+        d, depth = dir_stack.pop()
+
+        try:
+            with os.scandir(d) as it:
+                entries = list(it)
+        except OSError:
+            continue
+
+        subdirs = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+
+            if is_dir:
+                # like os.walk(), don't descend into symlinked directories
+                if depth < DEFAULT_MAX_DEPTH and \
+                        not entry.is_symlink():
+                    subdirs.append(entry.path)
+            elif name_filter(entry.name):
+                paths.append(entry.path)
+
+        dir_stack.extend((sd, depth + 1) for sd in reversed(subdirs))
+
+    return paths
+
 class CityscapesExtractor(SourceExtractor):
-    def __init__(self, path, subset=None):
+    """
+    Parameters:
+        cache_masks - when enabled, the decoded instance masks are stored
+            in the dataset directory (see `CityscapesPath.MASK_CACHE_DIR`),
+            and the next imports read them instead of decoding the PNG files
+    """
+
+    def __init__(self, path, subset=None, cache_masks=False):
         assert osp.isdir(path), path
 
         if not subset:
@@ -165,6 +286,12 @@ class CityscapesExtractor(SourceExtractor):
         self._images_dir = images_dir
         self._gt_anns_dir = annotations_dir
 
+        # The image and mask paths are produced by walking these directories,
+        # so item ids can be obtained by slicing instead of relpath() calls
+        self._images_prefix_len = len(osp.join(images_dir, ''))
+        self._gt_anns_prefix_len = len(osp.join(annotations_dir, ''))
+        self._cache_masks = cache_masks
+
         super().__init__(subset=subset)
 
         self._categories = self._load_categories(self._path)
@@ -181,46 +308,70 @@ class CityscapesExtractor(SourceExtractor):
         return make_cityscapes_categories(label_map)
 
     def _get_id_from_image_path(self, path):
-        return osp.relpath(osp.splitext(path)[0], self._images_dir) \
-            .replace('_' + CityscapesPath.ORIGINAL_IMAGE_DIR, '')
+        return osp.splitext(path)[0][self._images_prefix_len:] \
+            .replace(CityscapesPath.ORIGINAL_IMAGE, '')
 
     def _get_id_from_mask_path(self, path):
-        return osp.relpath(path, self._gt_anns_dir) \
-            .replace(CityscapesPath.GT_INSTANCE_MASK_SUFFIX, '')
+        if path.endswith(CityscapesPath.GT_MASKS_ARCHIVE_SUFFIX):
+            suffix = CityscapesPath.GT_MASKS_ARCHIVE_SUFFIX
+        else:
+            suffix = CityscapesPath.GT_INSTANCE_MASK_SUFFIX
+        return path[self._gt_anns_prefix_len:-len(suffix)]
 
     def _load_items(self):
         items = {}
-        image_path_by_id = {}
 
-        if self._images_dir:
+        # The directories are independent, so they are scanned concurrently
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            image_paths = executor.submit(_find_files, self._images_dir,
+                lambda filename: \
+                    osp.splitext(filename)[1].lower() in IMAGE_EXTENSIONS)
+
+            # Only the instance masks are needed, other masks are skipped.
+            # Both mask kinds are collected in a single directory scan.
+            # Mask archives are preferred over PNG files, if both exist.
+            mask_suffixes = (CityscapesPath.GT_INSTANCE_MASK_SUFFIX,
+                CityscapesPath.GT_MASKS_ARCHIVE_SUFFIX)
+            mask_path_by_id = {}
+            for p in sorted(_find_files(self._gt_anns_dir,
+                        lambda filename: filename.endswith(mask_suffixes)),
+                    key=lambda p: p.endswith(mask_suffixes[1])):
+                mask_path_by_id[self._get_id_from_mask_path(p)] = p
+            mask_paths = list(mask_path_by_id.values())
+
             image_path_by_id = {
                 self._get_id_from_image_path(p): p
-                for p in find_images(self._images_dir, recursive=True)
+                for p in image_paths.result()
             }
 
-        for mask_path in find_images(self._gt_anns_dir, recursive=True):
-            if not mask_path.endswith(CityscapesPath.GT_INSTANCE_MASK_SUFFIX):
-                continue
+        if self._cache_masks:
+            load_mask = self._load_cached_instance_mask
+        else:
+            load_mask = _load_instance_mask
 
+        for mask_path, instances_mask in \
+                _load_instance_masks(mask_paths, load_mask):
             item_id = self._get_id_from_mask_path(mask_path)
 
-            anns = []
-            instances_mask = load_image(mask_path, dtype=np.int32)
-            segm_ids = np.unique(instances_mask)
-            for segm_id in segm_ids:
-                # either is_crowd or ann_id should be set
-                if segm_id < 1000:
-                    label_id = segm_id
-                    is_crowd = True
-                    ann_id = None
-                else:
-                    label_id = segm_id // 1000
-                    is_crowd = False
-                    ann_id = segm_id % 1000
-                anns.append(Mask(
-                    image=self._lazy_extract_mask(instances_mask, segm_id),
-                    label=label_id, id=ann_id,
-                    attributes = { 'is_crowd': is_crowd }))
+            # The ids are small, so counting them takes a single pass
+            # over the image, unlike np.unique(), which sorts the image
+            segm_ids = np.flatnonzero(np.bincount(instances_mask.ravel()))
+
+            # Ids below 1000 are label ids of crowd annotations,
+            # others are made of label ids and annotation ids.
+            # Either is_crowd or ann_id should be set.
+            is_crowd = segm_ids < 1000
+            label_ids = np.where(is_crowd, segm_ids, segm_ids // 1000)
+            ann_ids = segm_ids % 1000
+
+            anns = [
+                Mask(image=extract_mask,
+                    label=label_id, id=None if crowd else ann_id,
+                    attributes={ 'is_crowd': crowd })
+                for extract_mask, label_id, ann_id, crowd in zip(
+                    self._lazy_extract_masks(instances_mask, segm_ids),
+                    label_ids.tolist(), ann_ids.tolist(), is_crowd.tolist())
+            ]
 
             items[item_id] = DatasetItem(id=item_id, subset=self._subset,
                 image=image_path_by_id.pop(item_id, None),
@@ -232,9 +383,45 @@ class CityscapesExtractor(SourceExtractor):
 
         return items
 
+    def _load_cached_instance_mask(self, mask_path):
+        cache_path = osp.join(self._path, CityscapesPath.MASK_CACHE_DIR,
+            osp.relpath(mask_path, self._path) + CityscapesPath.MASK_CACHE_EXT)
+
+        # The cache file gets the modification time of the mask file,
+        # so that any change of the mask invalidates the cache
+        mask_stat = os.stat(mask_path)
+        try:
+            if os.stat(cache_path).st_mtime_ns == mask_stat.st_mtime_ns:
+                return np.load(cache_path, allow_pickle=False)
+        except (OSError, ValueError):
+            pass
+
+        mask = _load_instance_mask(mask_path)
+
+        try:
+            os.makedirs(osp.dirname(cache_path), exist_ok=True)
+
+            # Write to a temporary file first, so that readers
+            # never see a partially written cache
+            tmp_path = cache_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, mask, allow_pickle=False)
+            os.utime(tmp_path,
+                ns=(mask_stat.st_atime_ns, mask_stat.st_mtime_ns))
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            log.debug("Failed to cache the mask '%s': %s", mask_path, e)
+
+        return mask
+
     @staticmethod
-    def _lazy_extract_mask(mask, c):
-        return lambda: mask == c
+    def _lazy_extract_masks(mask, segm_ids):
+        """
+        Returns a list of callables producing binary masks
+        for the corresponding segment ids of the instance map.
+        """
+
+        return [lambda v=v: mask == v for v in segm_ids.tolist()]
 
 class CityscapesImporter(Importer):
     @classmethod
@@ -254,6 +441,10 @@ class LabelmapType(Enum):
     cityscapes = auto()
     source = auto()
 
+class MaskFormat(Enum):
+    png = auto() # standard Cityscapes PNG masks
+    npz = auto() # a mask archive per item, see CityscapesPath.MASKS_ARCHIVE
+
 class CityscapesConverter(Converter):
     DEFAULT_IMAGE_EXT = '.png'
 
@@ -274,13 +465,24 @@ class CityscapesConverter(Converter):
         parser.add_argument('--label-map', type=cls._get_labelmap, default=None,
             help="Labelmap file path or one of %s" % \
                 ', '.join(t.name for t in LabelmapType))
+        parser.add_argument('--num-workers', type=int, default=1,
+            help="Number of threads used to save items. Values above 1 "
+                "speed up saving of big datasets at the cost of "
+                "higher memory use (default: %(default)s)")
+        parser.add_argument('--mask-format', default=MaskFormat.png.name,
+            choices=[f.name for f in MaskFormat],
+            help="Mask file format. 'npz' masks are faster to read, "
+                "but can only be read by Datumaro (default: %(default)s)")
         return parser
 
     def __init__(self, extractor, save_dir,
-            apply_colormap=True, label_map=None, **kwargs):
+            apply_colormap=True, label_map=None, num_workers=1,
+            mask_format=MaskFormat.png.name, **kwargs):
         super().__init__(extractor, save_dir, **kwargs)
 
         self._apply_colormap = apply_colormap
+        self._num_workers = num_workers
+        self._mask_format = MaskFormat[mask_format]
 
         if label_map is None:
             label_map = LabelmapType.source.name
@@ -290,50 +492,91 @@ class CityscapesConverter(Converter):
         os.makedirs(self._save_dir, exist_ok=True)
 
         for subset_name, subset in self._extractor.subsets().items():
-            for item in subset:
-                image_path = osp.join(CityscapesPath.IMGS_FINE_DIR,
-                    CityscapesPath.ORIGINAL_IMAGE_DIR, subset_name,
-                    item.id + CityscapesPath.ORIGINAL_IMAGE + \
-                        self._find_image_ext(item))
-                if self._save_images:
-                    self._save_image(item, osp.join(self._save_dir, image_path))
-
-                masks = [a for a in item.annotations
-                    if a.type == AnnotationType.mask]
-                if not masks:
-                    continue
-
-                # If a label can distinguish between instances,
-                # make id an instance id. Otherwise use label id.
-                compiled_mask = CompiledMask.from_instance_masks(masks,
-                    instance_ids = [self._label_id_mapping(m.label)
-                        if m.attributes.get('is_crowd', False)
-                        else self._label_id_mapping(m.label) * 1000 + \
-                            (m.id or (i + 1))
-                        for i, m in enumerate(masks)
-                    ],
-                    instance_labels=[self._label_id_mapping(m.label)
-                        for m in masks])
-
-                mask_dir = osp.join(self._save_dir,
-                    CityscapesPath.GT_FINE_DIR, subset_name)
-                mask_name = item.id + '_' + CityscapesPath.GT_FINE_DIR
-
-                color_mask_path = osp.join(mask_dir,
-                    mask_name + CityscapesPath.COLOR_IMAGE)
-                self.save_mask(color_mask_path, compiled_mask.class_mask)
-
-                cls_mask_path = osp.join(mask_dir,
-                    mask_name + CityscapesPath.LABELIDS_IMAGE)
-                self.save_mask(cls_mask_path, compiled_mask.class_mask,
-                    apply_colormap=False, dtype=np.uint8)
-
-                inst_mask_path = osp.join(mask_dir,
-                    mask_name + CityscapesPath.INSTANCES_IMAGE)
-                self.save_mask(inst_mask_path, compiled_mask.instance_mask,
-                    apply_colormap=False, dtype=np.int32)
+            self._save_items(subset_name, subset)
         self.save_label_map()
 
+    def _save_items(self, subset_name, items):
+        num_workers = self._num_workers
+        if num_workers <= 1:
+            for item in items:
+                self._save_item(subset_name, item)
+            return
+
+        # Mask painting and image encoding are mostly done in native code,
+        # which releases the GIL, so the items are saved in a thread pool.
+        # While some workers write masks of their items, others compile
+        # masks of the next items, so no separate writer threads are needed.
+        # The number of pending items is limited to keep memory use bounded.
+        max_pending = 2 * num_workers
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            pending = deque()
+            for item in items:
+                if len(pending) == max_pending:
+                    pending.popleft().result()
+                pending.append(
+                    executor.submit(self._save_item, subset_name, item))
+
+            while pending:
+                pending.popleft().result()
+
+    def _save_item(self, subset_name, item):
+        image_path = osp.join(CityscapesPath.IMGS_FINE_DIR,
+            CityscapesPath.ORIGINAL_IMAGE_DIR, subset_name,
+            item.id + CityscapesPath.ORIGINAL_IMAGE + \
+                self._find_image_ext(item))
+        if self._save_images:
+            self._save_image(item, osp.join(self._save_dir, image_path))
+
+        masks = [a for a in item.annotations
+            if a.type == AnnotationType.mask]
+        if not masks:
+            return
+
+        labels, is_crowd, ann_ids = zip(*(
+            (m.label, m.attributes.get('is_crowd', False), m.id or (i + 1))
+            for i, m in enumerate(masks)
+        ))
+        label_ids = self._map_label_ids(labels)
+        is_crowd = np.array(is_crowd, dtype=bool)
+        ann_ids = np.array(ann_ids, dtype=np.int64)
+
+        # If a label can distinguish between instances,
+        # make id an instance id. Otherwise use label id.
+        instance_ids = np.where(is_crowd, label_ids, label_ids * 1000 + ann_ids)
+
+        compiled_mask = CompiledMask.from_instance_masks(masks,
+            instance_ids=instance_ids, instance_labels=label_ids)
+
+        mask_dir = osp.join(self._save_dir,
+            CityscapesPath.GT_FINE_DIR, subset_name)
+        mask_name = item.id + '_' + CityscapesPath.GT_FINE_DIR
+
+        color_mask_path = osp.join(mask_dir,
+            mask_name + CityscapesPath.COLOR_IMAGE)
+        cls_mask_path = osp.join(mask_dir,
+            mask_name + CityscapesPath.LABELIDS_IMAGE)
+        inst_mask_path = osp.join(mask_dir,
+            mask_name + CityscapesPath.INSTANCES_IMAGE)
+        masks_archive_path = osp.join(mask_dir,
+            mask_name + CityscapesPath.MASKS_ARCHIVE)
+
+        if self._mask_format == MaskFormat.npz:
+            self.save_masks_archive(masks_archive_path, compiled_mask)
+            stale_paths = [color_mask_path, cls_mask_path, inst_mask_path]
+        else:
+            self.save_mask(color_mask_path, compiled_mask.class_mask)
+            self.save_mask(cls_mask_path, compiled_mask.class_mask,
+                apply_colormap=False, dtype=np.uint8)
+            self.save_mask(inst_mask_path, compiled_mask.instance_mask,
+                apply_colormap=False, dtype=np.int32)
+            stale_paths = [masks_archive_path]
+
+        if self._patch is not None:
+            # Remove the masks left from saving in the other format
+            for path in stale_paths:
+                if osp.isfile(path):
+                    os.unlink(path)
+
     def save_label_map(self):
         path = osp.join(self._save_dir, CityscapesPath.LABELMAP_FILE)
         labels = self._extractor.categories()[AnnotationType.label]
@@ -380,6 +623,21 @@ class CityscapesConverter(Converter):
         self._categories = make_cityscapes_categories(label_map)
         self._label_map = label_map
         self._label_id_mapping = self._make_label_id_map()
+        self._label_id_lut = self._make_label_id_lut()
+        self._palette = self._make_palette(
+            self._categories[AnnotationType.mask].colormap)
+
+    @staticmethod
+    def _make_palette(colormap):
+        # Same as in paint_mask(): a BGR color for every index,
+        # the indices without colors are painted white. The palette
+        # covers all the colormap indices, even if there are more than 256.
+        palette = np.full((max(256, max(colormap, default=-1) + 1), 3), 255,
+            dtype=np.uint8)
+        for index, color in colormap.items():
+            if 0 <= index:
+                palette[index] = color[::-1]
+        return palette
 
     def _make_label_id_map(self):
         map_id, id_mapping, src_labels, dst_labels = make_label_id_mapping(
@@ -404,12 +662,42 @@ class CityscapesConverter(Converter):
 
         return map_id
 
+    def _make_label_id_lut(self):
+        # The last element is the mapping for unknown labels
+        src_labels = self._extractor.categories().get(AnnotationType.label)
+        return np.array([self._label_id_mapping(i)
+            for i in range(len(src_labels or ()) + 1)], dtype=np.int32)
+
+    def _map_label_ids(self, labels):
+        lut = self._label_id_lut
+        unknown = len(lut) - 1
+        return lut[[label if label is not None and 0 <= label < unknown
+            else unknown for label in labels]]
+
+    @staticmethod
+    def save_masks_archive(path, compiled_mask):
+        os.makedirs(osp.dirname(path), exist_ok=True)
+        class_mask = compiled_mask.class_mask
+        np.savez(path,
+            class_mask=class_mask.astype(
+                np.min_scalar_type(max(class_mask.max(initial=0), 255))),
+            instance_mask=compiled_mask.instance_mask.astype(np.uint32))
+
     def save_mask(self, path, mask, colormap=None, apply_colormap=True,
             dtype=np.uint8):
         if apply_colormap:
             if colormap is None:
-                colormap = self._categories[AnnotationType.mask].colormap
-            mask = paint_mask(mask, colormap)
+                # The palette is computed once for all the masks
+                palette = self._palette
+                max_index = mask.max(initial=0)
+                if len(palette) <= max_index:
+                    # the indices without colors are painted white
+                    palette = np.concatenate([palette,
+                        np.full((max_index + 1 - len(palette), 3), 255,
+                            dtype=palette.dtype)])
+                mask = palette[mask]
+            else:
+                mask = paint_mask(mask, colormap)
         save_image(path, mask, create_dir=True, dtype=dtype)
 
     @classmethod
@@ -443,9 +731,11 @@ class CityscapesConverter(Converter):
                 mask_name + CityscapesPath.LABELIDS_IMAGE)
             inst_mask_path = osp.join(mask_dir,
                 mask_name + CityscapesPath.INSTANCES_IMAGE)
+            masks_archive_path = osp.join(mask_dir,
+                mask_name + CityscapesPath.MASKS_ARCHIVE)
 
             for path in [image_path, color_mask_path, labelids_mask_path,
-                    inst_mask_path]:
+                    inst_mask_path, masks_archive_path]:
                 if osp.isfile(path):
                     os.unlink(path)
 
@@ -3,15 +3,15 @@
 # SPDX-License-Identifier: MIT
 
 from collections import Counter
-from copy import deepcopy
+from copy import copy
 from enum import Enum, auto
-from itertools import chain
 from typing import Dict, Iterable, List, Tuple, Union
 import logging as log
 import os.path as osp
 import random
 import re
 
+import numpy as np
 import pycocotools.mask as mask_utils
 
 from datumaro.components.annotation import (
@@ -27,21 +27,41 @@ from datumaro.util.annotation_util import find_group_leader, find_instances
 import datumaro.util.mask_tools as mask_tools
 
 
+def _encode_rle(mask):
+    """
+    Encodes a binary mask into a compressed COCO RLE. Uses the pycocotools
+    encoder, which works directly on the column-major mask representation
+    and doesn't require intermediate uncompressed RLEs.
+    """
+
+    return mask_utils.encode(np.asfortranarray(mask, dtype=np.uint8))
+
+_SEGMENT_TYPES = frozenset({AnnotationType.polygon, AnnotationType.mask})
+
+def _get_image_size(item):
+    """
+    Returns the (H, W) size of the item image. The size is obtained once
+    per item, because it can require reading the image.
+    """
+
+    image_size = item.image.size if item.has_image else None
+    if image_size is None:
+        raise Exception("Image info is required for this transform")
+    return image_size
+
 class CropCoveredSegments(ItemTransform, CliPlugin):
     def transform_item(self, item):
         annotations = []
         segments = []
         for ann in item.annotations:
-            if ann.type in {AnnotationType.polygon, AnnotationType.mask}:
+            if ann.type in _SEGMENT_TYPES:
                 segments.append(ann)
             else:
                 annotations.append(ann)
         if not segments:
             return item
 
-        if not item.has_image:
-            raise Exception("Image info is required for this transform")
-        h, w = item.image.size
+        h, w = _get_image_size(item)
         segments = self.crop_segments(segments, w, h)
 
         annotations += segments
@@ -59,12 +79,15 @@ class CropCoveredSegments(ItemTransform, CliPlugin):
                 if isinstance(s, RleMask):
                     rle = s.rle
                 else:
-                    rle = mask_tools.mask_to_rle(s.image)
+                    rle = _encode_rle(s.image)
                 segments.append(rle)
 
         segments = mask_tools.crop_covered_segments(
             segments, img_width, img_height)
 
+        next_group_id = max((a.group or 0 for a in segment_anns),
+            default=0) + 1
+
         new_anns = []
         for ann, new_segment in zip(segment_anns, segments):
             fields = {'z_order': ann.z_order, 'label': ann.label,
@@ -72,24 +95,17 @@ class CropCoveredSegments(ItemTransform, CliPlugin):
             }
             if ann.type == AnnotationType.polygon:
                 if fields['group'] is None:
-                    fields['group'] = cls._make_group_id(
-                        segment_anns + new_anns, fields['id'])
+                    group_id = ann.id or next_group_id
+                    next_group_id = max(next_group_id, group_id + 1)
+                    fields['group'] = group_id
                 for polygon in new_segment:
                     new_anns.append(Polygon(points=polygon, **fields))
             else:
-                rle = mask_tools.mask_to_rle(new_segment)
-                rle = mask_utils.frPyObjects(rle, *rle['size'])
-                new_anns.append(RleMask(rle=rle, **fields))
+                new_anns.append(RleMask(rle=_encode_rle(new_segment),
+                    **fields))
 
         return new_anns
 
-    @staticmethod
-    def _make_group_id(anns, ann_id):
-        if ann_id:
-            return ann_id
-        max_gid = max(anns, default=0, key=lambda x: x.group)
-        return max_gid + 1
-
 class MergeInstanceSegments(ItemTransform, CliPlugin):
     """
     Replaces instance masks and, optionally, polygons with a single mask.
@@ -111,22 +127,18 @@ class MergeInstanceSegments(ItemTransform, CliPlugin):
         annotations = []
         segments = []
         for ann in item.annotations:
-            if ann.type in {AnnotationType.polygon, AnnotationType.mask}:
+            if ann.type in _SEGMENT_TYPES:
                 segments.append(ann)
             else:
                 annotations.append(ann)
         if not segments:
             return item
 
-        if not item.has_image:
-            raise Exception("Image info is required for this transform")
-        h, w = item.image.size
-        instances = self.find_instances(segments)
-        segments = [self.merge_segments(i, w, h, self._include_polygons)
-            for i in instances]
-        segments = sum(segments, [])
+        h, w = _get_image_size(item)
+        for instance in self.find_instances(segments):
+            annotations.extend(self.merge_segments(instance, w, h,
+                self._include_polygons))
 
-        annotations += segments
         return self.wrap_item(item, annotations=annotations)
 
     @classmethod
@@ -142,50 +154,65 @@ class MergeInstanceSegments(ItemTransform, CliPlugin):
         leader = find_group_leader(polygons + masks)
         instance = []
 
-        # Build the resulting mask
-        mask = None
+        # Build the resulting mask. The segments are merged in the RLE form,
+        # so no dense masks need to be allocated.
+        rles = [cls._to_rle(m) for m in masks]
 
         if include_polygons and polygons:
-            polygons = [p.points for p in polygons]
-            mask = mask_tools.rles_to_mask(polygons, img_width, img_height)
+            rles += mask_utils.frPyObjects([p.points for p in polygons],
+                img_height, img_width)
         else:
             instance += polygons # keep unused polygons
 
-        if masks:
-            masks = (m.image for m in masks)
-            if mask is not None:
-                masks = chain(masks, [mask])
-            mask = mask_tools.merge_masks(masks)
-
-        if mask is None:
+        if not rles:
             return instance
 
-        mask = mask_tools.mask_to_rle(mask)
-        mask = mask_utils.frPyObjects(mask, *mask['size'])
         instance.append(
-            RleMask(rle=mask, label=leader.label, z_order=leader.z_order,
+            RleMask(rle=mask_utils.merge(rles, intersect=False),
+                label=leader.label, z_order=leader.z_order,
                 id=leader.id, attributes=leader.attributes, group=leader.group
             )
         )
         return instance
 
+    @staticmethod
+    def _to_rle(mask):
+        if isinstance(mask, RleMask):
+            return mask.rle
+        return _encode_rle(mask.image)
+
     @staticmethod
     def find_instances(annotations):
         return find_instances(a for a in annotations
-            if a.type in {AnnotationType.polygon, AnnotationType.mask})
+            if a.type in _SEGMENT_TYPES)
+
+def _shapes_to_rle_masks(item, ann_type, get_polygon):
+    """
+    Replaces all the item annotations of the given type with RLE masks.
+    The polygons of all the converted annotations are encoded
+    in a single pycocotools call.
+    """
+
+    shapes = [(i, ann) for i, ann in enumerate(item.annotations)
+        if ann.type == ann_type]
+    if not shapes:
+        return item.annotations
+
+    h, w = _get_image_size(item)
+
+    rles = mask_utils.frPyObjects([get_polygon(s) for _, s in shapes], h, w)
+
+    annotations = list(item.annotations)
+    for (i, shape), rle in zip(shapes, rles):
+        annotations[i] = RleMask(rle=rle, label=shape.label,
+            z_order=shape.z_order, id=shape.id, attributes=shape.attributes,
+            group=shape.group)
+    return annotations
 
 class PolygonsToMasks(ItemTransform, CliPlugin):
     def transform_item(self, item):
-        annotations = []
-        for ann in item.annotations:
-            if ann.type == AnnotationType.polygon:
-                if not item.has_image:
-                    raise Exception("Image info is required for this transform")
-                h, w = item.image.size
-                annotations.append(self.convert_polygon(ann, h, w))
-            else:
-                annotations.append(ann)
-
+        annotations = _shapes_to_rle_masks(item, AnnotationType.polygon,
+            lambda polygon: polygon.points)
         return self.wrap_item(item, annotations=annotations)
 
     @staticmethod
@@ -197,16 +224,8 @@ class PolygonsToMasks(ItemTransform, CliPlugin):
 
 class BoxesToMasks(ItemTransform, CliPlugin):
     def transform_item(self, item):
-        annotations = []
-        for ann in item.annotations:
-            if ann.type == AnnotationType.bbox:
-                if not item.has_image:
-                    raise Exception("Image info is required for this transform")
-                h, w = item.image.size
-                annotations.append(self.convert_bbox(ann, h, w))
-            else:
-                annotations.append(ann)
-
+        annotations = _shapes_to_rle_masks(item, AnnotationType.bbox,
+            lambda bbox: bbox.as_polygon())
         return self.wrap_item(item, annotations=annotations)
 
     @staticmethod
@@ -244,12 +263,16 @@ class MasksToPolygons(ItemTransform, CliPlugin):
         ]
 
 class ShapesToBoxes(ItemTransform, CliPlugin):
+    _SHAPE_TYPES = frozenset({
+        AnnotationType.mask, AnnotationType.polygon,
+        AnnotationType.polyline, AnnotationType.points,
+    })
+
     def transform_item(self, item):
         annotations = []
+        shape_types = self._SHAPE_TYPES
         for ann in item.annotations:
-            if ann.type in { AnnotationType.mask, AnnotationType.polygon,
-                AnnotationType.polyline, AnnotationType.points,
-            }:
+            if ann.type in shape_types:
                 annotations.append(self.convert_shape(ann))
             else:
                 annotations.append(ann)
@@ -366,7 +389,9 @@ class RandomSplit(Transform, CliPlugin):
         indices = list(range(dataset_size))
         random.seed(seed)
         random.shuffle(indices)
-        parts = []
+        subset_names = []
+        index_to_subset = np.empty(dataset_size,
+            dtype=np.min_scalar_type(len(splits)))
         s = 0
         lower_boundary = 0
         for split_idx, (subset, ratio) in enumerate(splits):
@@ -374,19 +399,21 @@ class RandomSplit(Transform, CliPlugin):
             upper_boundary = int(s * dataset_size)
             if split_idx == len(splits) - 1:
                 upper_boundary = dataset_size
-            subset_indices = set(indices[lower_boundary : upper_boundary])
-            parts.append((subset_indices, subset))
+            index_to_subset[indices[lower_boundary : upper_boundary]] = \
+                split_idx
+            subset_names.append(subset)
             lower_boundary = upper_boundary
-        self._parts = parts
+        self._subset_names = tuple(subset_names)
+        self._index_to_subset = index_to_subset
 
         self._subsets = set(s[0] for s in splits)
         self._length = 'parent'
 
     def _find_split(self, index):
-        for subset_indices, subset in self._parts:
-            if index in subset_indices:
-                return subset
-        return subset # all the possible remainder goes to the last split
+        if index < len(self._index_to_subset):
+            return self._subset_names[self._index_to_subset[index]]
+        # all the possible remainder goes to the last split
+        return self._subset_names[-1]
 
     def __iter__(self):
         for i, item in enumerate(self._extractor):
@@ -432,9 +459,28 @@ class Rename(ItemTransform, CliPlugin):
         self._re = re.compile(regex)
         self._sub = sub
 
+        # Most replacements have no format tokens, which allows to avoid
+        # parsing the resulting ids as format strings
+        self._needs_format = '{' in sub or '}' in sub
+
     def transform_item(self, item):
-        return self.wrap_item(item, id=self._re.sub(self._sub, item.id) \
-            .format(item=item))
+        new_id = self._re.sub(self._sub, item.id)
+        if self._needs_format:
+            new_id = new_id.format(item=item)
+        return self.wrap_item(item, id=new_id)
+
+# The category information consists of plain containers of immutable values,
+# so it can be copied much faster than with deepcopy()
+
+def _copy_label_categories(label_cat):
+    copied = LabelCategories(attributes=copy(label_cat.attributes))
+    for label in label_cat:
+        copied.add(label.name, label.parent, copy(label.attributes))
+    return copied
+
+def _copy_points_category(points_cat):
+    return PointsCategories.Category(
+        copy(points_cat.labels), copy(points_cat.joints))
 
 class RemapLabels(ItemTransform, CliPlugin):
     """
@@ -508,11 +554,11 @@ class RemapLabels(ItemTransform, CliPlugin):
         if src_mask_cat is not None:
             assert src_label_cat is not None
             dst_mask_cat = MaskCategories(
-                attributes=deepcopy(src_mask_cat.attributes))
+                attributes=copy(src_mask_cat.attributes))
             for old_id, old_color in src_mask_cat.colormap.items():
                 new_id = self._map_id(old_id)
                 if new_id is not None and new_id not in dst_mask_cat:
-                    dst_mask_cat.colormap[new_id] = deepcopy(old_color)
+                    dst_mask_cat.colormap[new_id] = copy(old_color)
 
             self._categories[AnnotationType.mask] = dst_mask_cat
 
@@ -520,11 +566,11 @@ class RemapLabels(ItemTransform, CliPlugin):
         if src_point_cat is not None:
             assert src_label_cat is not None
             dst_point_cat = PointsCategories(
-                attributes=deepcopy(src_point_cat.attributes))
+                attributes=copy(src_point_cat.attributes))
             for old_id, old_cat in src_point_cat.items.items():
                 new_id = self._map_id(old_id)
                 if new_id is not None and new_id not in dst_point_cat:
-                    dst_point_cat.items[new_id] = deepcopy(old_cat)
+                    dst_point_cat.items[new_id] = _copy_points_category(old_cat)
 
             self._categories[AnnotationType.points] = dst_point_cat
 
@@ -532,7 +578,7 @@ class RemapLabels(ItemTransform, CliPlugin):
 
     def _make_label_id_map(self, src_label_cat, label_mapping, default_action):
         dst_label_cat = LabelCategories(
-            attributes=deepcopy(src_label_cat.attributes))
+            attributes=copy(src_label_cat.attributes))
 
         id_mapping = {}
         for src_index, src_label in enumerate(src_label_cat.items):
@@ -545,7 +591,7 @@ class RemapLabels(ItemTransform, CliPlugin):
             dst_index = dst_label_cat.find(dst_label)[0]
             if dst_index is None:
                 dst_index = dst_label_cat.add(dst_label,
-                    src_label.parent, deepcopy(src_label.attributes))
+                    src_label.parent, copy(src_label.attributes))
             id_mapping[src_index] = dst_index
 
         if log.getLogger().isEnabledFor(log.DEBUG):
@@ -559,7 +605,7 @@ class RemapLabels(ItemTransform, CliPlugin):
                 else:
                     log.debug("#%s '%s' -> <deleted>", src_id, src_label.name)
 
-        self._map_id = lambda src_id: id_mapping.get(src_id, None)
+        self._map_id = id_mapping.get
 
         for label in dst_label_cat:
             if label.parent not in dst_label_cat:
@@ -571,13 +617,17 @@ class RemapLabels(ItemTransform, CliPlugin):
 
     def transform_item(self, item):
         annotations = []
+        map_id = self._map_id
+        keep_unlabeled = self._default_action is self.DefaultAction.keep
         for ann in item.annotations:
             if getattr(ann, 'label', None) is not None:
-                conv_label = self._map_id(ann.label)
-                if conv_label is not None:
+                conv_label = map_id(ann.label)
+                if conv_label == ann.label:
+                    annotations.append(ann)
+                elif conv_label is not None:
                     annotations.append(ann.wrap(label=conv_label))
-            elif self._default_action is self.DefaultAction.keep:
-                annotations.append(ann.wrap())
+            elif keep_unlabeled:
+                annotations.append(ann)
         return item.wrap(annotations=annotations)
 
 class ProjectLabels(ItemTransform):
@@ -616,20 +666,20 @@ class ProjectLabels(ItemTransform):
         src_label_cat = src_categories.get(AnnotationType.label)
 
         if isinstance(dst_labels, LabelCategories):
-            dst_label_cat = deepcopy(dst_labels)
+            dst_label_cat = _copy_label_categories(dst_labels)
         else:
             dst_labels = list(dst_labels)
 
             if src_label_cat:
                 dst_label_cat = LabelCategories(
-                    attributes=deepcopy(src_label_cat.attributes))
+                    attributes=copy(src_label_cat.attributes))
 
                 for dst_label in dst_labels:
                     assert isinstance(dst_label, str)
                     src_label = src_label_cat.find(dst_label)[1]
                     if src_label is not None:
                         dst_label_cat.add(dst_label, src_label.parent,
-                            deepcopy(src_label.attributes))
+                            copy(src_label.attributes))
                     else:
                         dst_label_cat.add(dst_label)
             else:
@@ -646,11 +696,11 @@ class ProjectLabels(ItemTransform):
         if src_mask_cat is not None:
             assert src_label_cat is not None
             dst_mask_cat = MaskCategories(
-                attributes=deepcopy(src_mask_cat.attributes))
+                attributes=copy(src_mask_cat.attributes))
             for old_id, old_color in src_mask_cat.colormap.items():
                 new_id = self._map_id(old_id)
                 if new_id is not None and new_id not in dst_mask_cat:
-                    dst_mask_cat.colormap[new_id] = deepcopy(old_color)
+                    dst_mask_cat.colormap[new_id] = copy(old_color)
 
             # Generate new colors for new labels, keep old untouched
             existing_colors = set(dst_mask_cat.colormap.values())
@@ -674,11 +724,11 @@ class ProjectLabels(ItemTransform):
         if src_point_cat is not None:
             assert src_label_cat is not None
             dst_point_cat = PointsCategories(
-                attributes=deepcopy(src_point_cat.attributes))
+                attributes=copy(src_point_cat.attributes))
             for old_id, old_cat in src_point_cat.items.items():
                 new_id = self._map_id(old_id)
                 if new_id is not None and new_id not in dst_point_cat:
-                    dst_point_cat.items[new_id] = deepcopy(old_cat)
+                    dst_point_cat.items[new_id] = _copy_points_category(old_cat)
 
             self._categories[AnnotationType.points] = dst_point_cat
 
@@ -687,20 +737,23 @@ class ProjectLabels(ItemTransform):
             src_id: dst_label_cat.find(src_label_cat[src_id].name)[0]
             for src_id in range(len(src_label_cat or ()))
         }
-        self._map_id = lambda src_id: id_mapping.get(src_id, None)
+        self._map_id = id_mapping.get
 
     def categories(self):
         return self._categories
 
     def transform_item(self, item):
         annotations = []
+        map_id = self._map_id
         for ann in item.annotations:
             if getattr(ann, 'label', None) is not None:
-                conv_label = self._map_id(ann.label)
-                if conv_label is not None:
+                conv_label = map_id(ann.label)
+                if conv_label == ann.label:
+                    annotations.append(ann)
+                elif conv_label is not None:
                     annotations.append(ann.wrap(label=conv_label))
             else:
-                annotations.append(ann.wrap())
+                annotations.append(ann)
         return item.wrap(annotations=annotations)
 
 class AnnsToLabels(ItemTransform, CliPlugin):
@@ -710,13 +763,13 @@ class AnnsToLabels(ItemTransform, CliPlugin):
     """
 
     def transform_item(self, item):
-        labels = set(p.label for p in item.annotations
-            if getattr(p, 'label') != None)
-        annotations = []
-        for label in labels:
-            annotations.append(Label(label=label))
+        labels = {} # dict keys keep the order of the first occurrences
+        for p in item.annotations:
+            label = getattr(p, 'label', None)
+            if label is not None:
+                labels[label] = None
 
-        return item.wrap(annotations=annotations)
+        return item.wrap(annotations=[Label(label=label) for label in labels])
 
 class BboxValuesDecrement(ItemTransform, CliPlugin):
     """
@@ -724,13 +777,10 @@ class BboxValuesDecrement(ItemTransform, CliPlugin):
     """
 
     def transform_item(self, item):
-        annotations = [p for p in item.annotations
-            if p.type != AnnotationType.bbox]
-        bboxes = [p for p in item.annotations
-            if p.type == AnnotationType.bbox]
-        for bbox in bboxes:
-            annotations.append(Bbox(
-                bbox.x - 1, bbox.y - 1, bbox.w, bbox.h,
-                label=bbox.label, attributes=bbox.attributes))
+        annotations = []
+        for p in item.annotations:
+            if p.type == AnnotationType.bbox:
+                p = p.wrap(x=p.x - 1, y=p.y - 1)
+            annotations.append(p)
 
         return item.wrap(annotations=annotations)
@@ -3,6 +3,7 @@
 # SPDX-License-Identifier: MIT
 
 from collections import OrderedDict
+import threading
 
 _instance = None
 
@@ -20,22 +21,29 @@ class ImageCache:
         self.capacity = int(capacity)
         self.items = OrderedDict()
 
+        # The cache can be used by several threads, e.g. by converters
+        # saving items in parallel
+        self._lock = threading.Lock()
+
     def push(self, item_id, image):
-        if self.capacity <= len(self.items):
-            self.items.popitem(last=True)
-        self.items[item_id] = image
+        with self._lock:
+            if self.capacity <= len(self.items):
+                self.items.popitem(last=True)
+            self.items[item_id] = image
 
     def get(self, item_id):
         default = object()
-        item = self.items.get(item_id, default)
-        if item is default:
-            return None
+        with self._lock:
+            item = self.items.get(item_id, default)
+            if item is default:
+                return None
 
-        self.items.move_to_end(item_id, last=False) # naive splay tree
+            self.items.move_to_end(item_id, last=False) # naive splay tree
         return item
 
     def size(self):
         return len(self.items)
 
     def clear(self):
-        self.items.clear()
+        with self._lock:
+            self.items.clear()
@@ -176,7 +176,7 @@ def mask_to_polygons(mask, area_threshold=1):
 
     polygons = []
 
-    contours, _ = cv2.findContours(mask.astype(np.uint8),
+    contours, _ = cv2.findContours(mask.astype(np.uint8, copy=False),
         mode=cv2.RETR_TREE, method=cv2.CHAIN_APPROX_TC89_KCOS)
 
     for contour in contours:
@@ -189,12 +189,16 @@ def mask_to_polygons(mask, area_threshold=1):
             contour = np.vstack((contour, contour[0])) # make polygon closed
         contour = contour.flatten().clip(0) # [x0, y0, ...]
 
-        # Check if the polygon is big enough
-        rle = mask_utils.frPyObjects([contour], mask.shape[0], mask.shape[1])
-        area = sum(mask_utils.area(rle))
-        if area_threshold <= area:
-            polygons.append(contour)
-    return polygons
+        polygons.append(contour)
+
+    if not polygons:
+        return polygons
+
+    # Check if the polygons are big enough. The areas of all the polygons
+    # are computed in a single call.
+    rles = mask_utils.frPyObjects(polygons, mask.shape[0], mask.shape[1])
+    areas = mask_utils.area(rles)
+    return [p for p, area in zip(polygons, areas) if area_threshold <= area]
 
 def crop_covered_segments(segments, width, height,
         iou_threshold=0.0, ratio_tolerance=0.001, area_threshold=1,
@@ -204,7 +208,8 @@ def crop_covered_segments(segments, width, height,
     Input segments are expected to be sorted from background to foreground.
 
     Args:
-        segments: 1d list of segment RLEs (in COCO format)
+        segments: 1d list of segment polygons and RLEs (in COCO format),
+            RLEs can be compressed or uncompressed
         width: width of the image
         height: height of the image
         iou_threshold: IoU threshold for objects to be counted as intersected
@@ -226,24 +231,35 @@ def crop_covered_segments(segments, width, height,
     from pycocotools import mask as mask_utils
 
     segments = [[s] for s in segments]
-    input_rles = [mask_utils.frPyObjects(s, height, width) for s in segments]
+    input_rles = [
+        # Compressed RLEs can be used as is
+        s[0] if isinstance(s[0], dict) and \
+            isinstance(s[0]['counts'], (bytes, str)) \
+        else mask_utils.frPyObjects(s, height, width)[0]
+        for s in segments
+    ]
+    areas = mask_utils.area(input_rles) if input_rles else []
 
     for i, rle_bottom in enumerate(input_rles):
-        area_bottom = sum(mask_utils.area(rle_bottom))
+        area_bottom = areas[i]
         if area_bottom < area_threshold:
             segments[i] = [] if not return_masks else None
             continue
 
-        rles_top = []
-        for j in range(i + 1, len(input_rles)):
-            rle_top = input_rles[j]
-            iou = sum(mask_utils.iou(rle_bottom, rle_top, [0]))[0]
+        # The overlaps with all the upper segments are computed in one call
+        upper_rles = input_rles[i + 1:]
+        if upper_rles:
+            ious = mask_utils.iou([rle_bottom], upper_rles,
+                [0] * len(upper_rles))[0]
+        else:
+            ious = []
 
+        rles_top = []
+        for j, iou in enumerate(ious, start=i + 1):
             if iou <= iou_threshold:
                 continue
 
-            area_top = sum(mask_utils.area(rle_top))
-            area_ratio = area_top / area_bottom
+            area_ratio = areas[j] / area_bottom
 
             # If a segment is fully inside another one, skip this segment
             if abs(area_ratio - iou) < ratio_tolerance:
@@ -255,21 +271,17 @@ def crop_covered_segments(segments, width, height,
                 rles_top = []
                 break
 
-            rles_top += rle_top
+            rles_top.append(input_rles[j])
 
         if not rles_top and not isinstance(segments[i][0], dict) \
                 and not return_masks:
             continue
 
-        rle_bottom = rle_bottom[0]
         bottom_mask = mask_utils.decode(rle_bottom).astype(np.uint8)
 
         if rles_top:
             rle_top = mask_utils.merge(rles_top)
-            top_mask = mask_utils.decode(rle_top).astype(np.uint8)
-
-            bottom_mask -= top_mask
-            bottom_mask[bottom_mask != 1] = 0
+            bottom_mask[mask_utils.decode(rle_top) != 0] = 0
 
         if not return_masks and not isinstance(segments[i][0], dict):
             segments[i] = mask_to_polygons(bottom_mask,
@@ -312,13 +324,22 @@ def merge_masks(masks, start=None):
         merged_mask = next(it)
         if isinstance(merged_mask, tuple) and len(merged_mask) == 2:
             merged_mask = merged_mask[0] * merged_mask[1]
+        else:
+            merged_mask = np.array(merged_mask)
     except StopIteration:
         return None
 
+    # The result is updated inplace, so that only the result and
+    # the current input mask are kept in memory
     for m in it:
         if isinstance(m, tuple) and len(m) == 2:
-            merged_mask = np.where(m[0], m[1], merged_mask)
+            mask, value = m
         else:
-            merged_mask = np.where(m, m, merged_mask)
+            mask = value = m
+
+        dtype = np.result_type(merged_mask, value)
+        if dtype != merged_mask.dtype:
+            merged_mask = merged_mask.astype(dtype)
+        np.copyto(merged_mask, value, where=mask.astype(bool, copy=False))
 
     return merged_mask
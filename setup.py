@@ -72,6 +72,7 @@ setuptools.setup(
     extras_require={
         'tf': ['tensorflow'],
         'tf-gpu': ['tensorflow-gpu'],
+        'pyspng': ['pyspng'],
         'default': DEFAULT_REQUIREMENTS,
     },
     entry_points={
@@ -1,8 +1,9 @@
 from collections import OrderedDict
 from functools import partial
-from unittest import TestCase
+from unittest import TestCase, mock, skipIf
 import os
 import os.path as osp
+import shutil
 
 import numpy as np
 
@@ -19,6 +20,7 @@ from datumaro.plugins.cityscapes_format import (
 from datumaro.util.test_utils import (
     IGNORE_ALL, TestDir, compare_datasets, test_save_and_load,
 )
+from datumaro.util.image import load_image
 import datumaro.plugins.cityscapes_format as Cityscapes
 
 from .requirements import Requirements, mark_requirement
@@ -94,6 +96,89 @@ class CityscapesImportTest(TestCase):
 
         compare_datasets(self, source_dataset, parsed_dataset)
 
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_imported_masks_are_writable(self):
+        dataset = Dataset.import_from(DUMMY_DATASET_DIR, 'cityscapes')
+        mask = dataset.get('defaultcity/defaultcity_000001_000031',
+            'test').annotations[0]
+
+        image = mask.image
+        image[:] = 0
+
+        self.assertTrue(np.any(mask.image))
+
+    @skipIf(Cityscapes.pyspng is None, "pyspng library is not available")
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_can_import_with_and_without_pyspng(self):
+        with mock.patch.object(Cityscapes, 'pyspng', None):
+            expected_dataset = Dataset.import_from(DUMMY_DATASET_DIR,
+                'cityscapes')
+
+        with mock.patch.object(Cityscapes.pyspng, 'load',
+                wraps=Cityscapes.pyspng.load) as pyspng_load:
+            parsed_dataset = Dataset.import_from(DUMMY_DATASET_DIR,
+                'cityscapes')
+
+        self.assertTrue(pyspng_load.called)
+        compare_datasets(self, expected_dataset, parsed_dataset)
+
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_can_import_without_pyspng(self):
+        with mock.patch.object(Cityscapes, 'pyspng', None):
+            self.test_can_import()
+
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_can_import_without_decode_threads(self):
+        expected_dataset = Dataset.import_from(DUMMY_DATASET_DIR, 'cityscapes')
+
+        env_var = Cityscapes.NUM_DECODE_THREADS_ENV_VAR
+        old_value = os.environ.get(env_var)
+        os.environ[env_var] = '1'
+        try:
+            parsed_dataset = Dataset.import_from(DUMMY_DATASET_DIR,
+                'cityscapes')
+        finally:
+            if old_value is None:
+                del os.environ[env_var]
+            else:
+                os.environ[env_var] = old_value
+
+        compare_datasets(self, expected_dataset, parsed_dataset)
+
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_can_import_with_mask_cache(self):
+        expected_dataset = Dataset.import_from(DUMMY_DATASET_DIR, 'cityscapes')
+
+        with TestDir() as test_dir:
+            dataset_dir = osp.join(test_dir, 'dataset')
+            shutil.copytree(DUMMY_DATASET_DIR, dataset_dir)
+            cache_dir = osp.join(dataset_dir,
+                Cityscapes.CityscapesPath.MASK_CACHE_DIR)
+
+            for _ in range(2):
+                parsed_dataset = Dataset.import_from(dataset_dir, 'cityscapes',
+                    cache_masks=True)
+                compare_datasets(self, expected_dataset, parsed_dataset)
+                self.assertTrue(osp.isdir(cache_dir))
+
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_can_reimport_changed_dataset(self):
+        with TestDir() as test_dir:
+            dataset_dir = osp.join(test_dir, 'dataset')
+            shutil.copytree(DUMMY_DATASET_DIR, dataset_dir)
+
+            dataset = Dataset.import_from(dataset_dir, 'cityscapes')
+            self.assertEqual(3, len(dataset.get(
+                'defaultcity/defaultcity_000001_000031', 'test').annotations))
+
+            mask_dir = osp.join(dataset_dir, 'gtFine', 'test', 'defaultcity')
+            os.remove(osp.join(mask_dir,
+                'defaultcity_000001_000031_gtFine_instanceIds.png'))
+
+            dataset = Dataset.import_from(dataset_dir, 'cityscapes')
+            self.assertEqual(0, len(dataset.get(
+                'defaultcity/defaultcity_000001_000031', 'test').annotations))
+
     @mark_requirement(Requirements.DATUM_267)
     def test_can_detect_cityscapes(self):
         detected_formats = Environment().detect_dataset(DUMMY_DATASET_DIR)
@@ -147,6 +232,50 @@ class CityscapesConverterTest(TestCase):
                 partial(CityscapesConverter.convert, label_map='cityscapes',
                     save_images=True), test_dir)
 
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_can_save_in_several_threads(self):
+        source_dataset = Dataset.from_iterable([
+            DatasetItem(id='defaultcity_%s' % i, subset='test',
+                image=np.ones((1, 5, 3)),
+                annotations=[
+                    Mask(np.array([[1, 0, 0, 1, 1]]), label=3,
+                        attributes={'is_crowd': True}),
+                    Mask(np.array([[0, 1, 1, 0, 0]]), label=24, id=i + 1,
+                        attributes={'is_crowd': False}),
+                ]
+            ) for i in range(10)
+        ], categories=Cityscapes.make_cityscapes_categories())
+
+        with TestDir() as test_dir:
+            self._test_save_and_load(source_dataset,
+                partial(CityscapesConverter.convert, label_map='cityscapes',
+                    save_images=True, num_workers=2), test_dir)
+
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_can_save_and_load_npz_masks(self):
+        class TestExtractor(TestExtractorBase):
+            def __iter__(self):
+                return iter([
+                    DatasetItem(id='defaultcity_1_2', subset='test',
+                        image=np.ones((1, 5, 3)),
+                        annotations=[
+                            Mask(np.array([[1, 0, 0, 1, 1]]), label=3,
+                                attributes={'is_crowd': True}),
+                            Mask(np.array([[0, 1, 1, 0, 0]]), label=24, id=1,
+                                attributes={'is_crowd': False}),
+                        ]
+                    ),
+                ])
+
+        with TestDir() as test_dir:
+            self._test_save_and_load(TestExtractor(),
+                partial(CityscapesConverter.convert, label_map='cityscapes',
+                    save_images=True, mask_format='npz'), test_dir)
+
+            mask_dir = osp.join(test_dir, 'gtFine', 'test')
+            self.assertEqual(['defaultcity_1_2_gtFine_masks.npz'],
+                os.listdir(mask_dir))
+
     @mark_requirement(Requirements.DATUM_267)
     def test_can_save_with_no_subsets(self):
         class TestExtractor(TestExtractorBase):
@@ -267,6 +396,42 @@ class CityscapesConverterTest(TestCase):
                 partial(CityscapesConverter.convert, label_map='source',
                     save_images=True), test_dir, target_dataset=DstExtractor())
 
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_can_save_masks_with_more_than_256_labels(self):
+        source_dataset = Dataset.from_iterable([
+            DatasetItem(id='a', subset='test', annotations=[
+                Mask(np.array([[1, 1, 0, 0, 0]]), label=43),
+                Mask(np.array([[0, 0, 1, 1, 1]]), label=299),
+            ]),
+        ], categories=Cityscapes.make_cityscapes_categories(OrderedDict(
+            ('label_%s' % i, (i % 256, i // 256, 0)) for i in range(300)
+        )))
+
+        with TestDir() as test_dir:
+            CityscapesConverter.convert(source_dataset, test_dir,
+                label_map='source', mask_format='npz')
+            CityscapesConverter.convert(source_dataset, test_dir,
+                label_map='source')
+
+            label_map = Cityscapes.parse_label_map(osp.join(test_dir,
+                Cityscapes.CityscapesPath.LABELMAP_FILE))
+            mask_name = osp.join(test_dir, 'gtFine', 'test',
+                'a_' + Cityscapes.CityscapesPath.GT_FINE_DIR)
+
+            color_mask = load_image(
+                mask_name + Cityscapes.CityscapesPath.COLOR_IMAGE)
+            self.assertEqual(tuple(color_mask[0, 0, ::-1]),
+                tuple(label_map['label_43']))
+            self.assertEqual(tuple(color_mask[0, 4, ::-1]),
+                tuple(label_map['label_299']))
+            self.assertNotEqual(tuple(color_mask[0, 0]),
+                tuple(color_mask[0, 4]))
+
+            with np.load(mask_name + Cityscapes.CityscapesPath.MASKS_ARCHIVE,
+                    allow_pickle=False) as masks:
+                self.assertEqual(masks['class_mask'][0, 4],
+                    list(label_map).index('label_299'))
+
     @mark_requirement(Requirements.DATUM_267)
     def test_dataset_with_source_labelmap_defined(self):
         class SrcExtractor(TestExtractorBase):
@@ -1,8 +1,12 @@
 from unittest import TestCase
+import os
 import os.path as osp
+import pickle
+import time
 
 from datumaro.components.format_detection import (
-    FormatDetectionConfidence, FormatRequirementsUnmet, apply_format_detector,
+    DetectionSession, FormatDetectionConfidence, FormatDetectionContext,
+    FormatRequirementsUnmet, apply_format_detector, apply_format_detectors,
 )
 from datumaro.util.test_utils import TestDir
 
@@ -46,6 +50,33 @@ class FormatDetectionTest(TestCase):
 
         self.assertEqual(result.exception.failed_alternatives, ('abcde',))
 
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_requirements_unmet_can_be_printed_and_pickled(self):
+        def detect_fail(context):
+            context.fail('abcde')
+
+        def detect_any(context):
+            with context.require_any():
+                with context.alternative():
+                    context.fail('abc')
+                with context.alternative():
+                    context.fail('de')
+
+        for detect, expected in [
+            (detect_fail, ('abcde',)),
+            (detect_any, ('abc', 'de')),
+        ]:
+            with self.subTest(expected=expected):
+                with self.assertRaises(FormatRequirementsUnmet) as result:
+                    apply_format_detector(self._dataset_root, detect)
+
+                e = result.exception
+                self.assertIn('abc', str(e))
+
+                restored = pickle.loads(pickle.dumps(e))
+                self.assertEqual(restored.failed_alternatives, expected)
+                self.assertEqual(str(restored), str(e))
+
     @mark_requirement(Requirements.DATUM_GENERAL_REQ)
     def test_require_file_success(self):
         with open(osp.join(self._dataset_root, 'foobar.txt'), 'w'):
@@ -75,6 +106,155 @@ class FormatDetectionTest(TestCase):
         self.assertEqual(len(result.exception.failed_alternatives), 1)
         self.assertIn('*/*', result.exception.failed_alternatives[0])
 
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_require_file_nested_patterns(self):
+        os.makedirs(osp.join(self._dataset_root, 'a', 'b', 'c'))
+        with open(osp.join(self._dataset_root, 'a', 'b', 'c', 'foo.txt'), 'w'):
+            pass
+
+        for pattern in ['a/b/c/foo.txt', 'a/*/c/*.txt', '**/foo.txt',
+                'a/**/c/foo.txt', 'a/**/*.txt', 'a/**', '**/b/**/foo.*']:
+            with self.subTest(pattern=pattern):
+                selected_file: str
+                def detect(context):
+                    nonlocal selected_file
+                    selected_file = context.require_file(pattern)
+
+                apply_format_detector(self._dataset_root, detect)
+
+                self.assertEqual(selected_file,
+                    osp.join('a', 'b', 'c', 'foo.txt'))
+
+        for pattern in ['a/b/foo.txt', 'a/*/foo.txt', 'a/b/c', 'a/b/c/',
+                '*/*/*/*/foo.txt', '**/c']:
+            with self.subTest(pattern=pattern):
+                with self.assertRaises(FormatRequirementsUnmet):
+                    apply_format_detector(self._dataset_root,
+                        lambda context: context.require_file(pattern))
+
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_require_file_follows_dir_symlinks(self):
+        real_dir = osp.join(self._dataset_root, 'real')
+        os.makedirs(osp.join(real_dir, 'sub'))
+        with open(osp.join(real_dir, 'sub', 'a.json'), 'w'):
+            pass
+
+        root = osp.join(self._dataset_root, 'root')
+        os.makedirs(root)
+        try:
+            os.symlink(osp.join(real_dir, 'sub'), osp.join(root, 'linked'),
+                target_is_directory=True)
+            # a symlink loop must not be traversed infinitely
+            os.symlink(root, osp.join(root, 'loop'),
+                target_is_directory=True)
+        except (OSError, NotImplementedError):
+            self.skipTest("Symlinks are not supported")
+
+        for pattern in ['**/*.json', 'linked/*.json', '*/a.json']:
+            with self.subTest(pattern=pattern):
+                selected_file: str
+                def detect(context):
+                    nonlocal selected_file
+                    selected_file = context.require_file(pattern)
+
+                apply_format_detector(root, detect)
+
+                self.assertEqual(selected_file, osp.join('linked', 'a.json'))
+
+        with self.assertRaises(FormatRequirementsUnmet):
+            apply_format_detector(root,
+                lambda context: context.require_file('**/*.txt'))
+
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_require_file_skips_hidden_files(self):
+        os.makedirs(osp.join(self._dataset_root, '.hidden'))
+        with open(osp.join(self._dataset_root, '.hidden', 'foo.txt'), 'w'):
+            pass
+        with open(osp.join(self._dataset_root, '.foo.txt'), 'w'):
+            pass
+
+        for pattern in ['*.txt', '*/foo.txt', '**/foo.txt']:
+            with self.subTest(pattern=pattern):
+                with self.assertRaises(FormatRequirementsUnmet):
+                    apply_format_detector(self._dataset_root,
+                        lambda context: context.require_file(pattern))
+
+        for pattern in ['.*.txt', '.hidden/*.txt', '.*/foo.txt']:
+            with self.subTest(pattern=pattern):
+                apply_format_detector(self._dataset_root,
+                    lambda context: context.require_file(pattern))
+
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_require_file_skips_pruned_dirs(self):
+        os.makedirs(osp.join(self._dataset_root, 'node_modules', 'a'))
+        with open(osp.join(self._dataset_root,
+                'node_modules', 'a', 'foo.txt'), 'w'):
+            pass
+
+        for pattern in ['**/foo.txt', '*/a/foo.txt']:
+            with self.subTest(pattern=pattern):
+                with self.assertRaises(FormatRequirementsUnmet):
+                    apply_format_detector(self._dataset_root,
+                        lambda context: context.require_file(pattern))
+
+                apply_format_detector(self._dataset_root,
+                    lambda context: context.require_file(pattern),
+                    prune_dirs=())
+
+        # explicitly named directories are not skipped
+        apply_format_detector(self._dataset_root,
+            lambda context: context.require_file('node_modules/*/foo.txt'))
+
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_require_file_outside_root(self):
+        for pattern in ['..', osp.join('..', '*'), osp.join('a', '..', '..')]:
+            with self.subTest(pattern=pattern):
+                with self.assertRaises(FormatRequirementsUnmet):
+                    apply_format_detector(self._dataset_root,
+                        lambda context: context.require_file(pattern))
+
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_require_file_results_are_shared_in_session(self):
+        file_path = osp.join(self._dataset_root, 'foobar.txt')
+        with open(file_path, 'w'):
+            pass
+
+        session = DetectionSession(self._dataset_root)
+
+        def detect(context):
+            context.require_file('*.txt')
+
+        apply_format_detector(self._dataset_root, detect, session=session)
+
+        # the session must not look at the filesystem again
+        os.remove(file_path)
+        apply_format_detector(self._dataset_root, detect, session=session)
+
+        with self.assertRaises(FormatRequirementsUnmet):
+            apply_format_detector(self._dataset_root, detect)
+
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_session_notices_directory_changes(self):
+        with open(osp.join(self._dataset_root, 'foobar.txt'), 'w'):
+            pass
+
+        session = DetectionSession(self._dataset_root)
+
+        apply_format_detector(self._dataset_root,
+            lambda context: context.require_file('*.txt'), session=session)
+
+        with open(osp.join(self._dataset_root, 'foobar.dat'), 'w'):
+            pass
+
+        selected_file: str
+        def detect(context):
+            nonlocal selected_file
+            selected_file = context.require_file('*.dat')
+
+        apply_format_detector(self._dataset_root, detect, session=session)
+
+        self.assertEqual(selected_file, 'foobar.dat')
+
     @mark_requirement(Requirements.DATUM_GENERAL_REQ)
     def test_require_file_exclude_fname_one(self):
         with open(osp.join(self._dataset_root, 'foobar.txt'), 'w'):
@@ -163,6 +343,45 @@ class FormatDetectionTest(TestCase):
         self.assertEqual(result.exception.failed_alternatives,
             ('abcde',))
 
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_probe_binary_header_success(self):
+        with open(osp.join(self._dataset_root, 'foobar.bin'), 'wb') as f:
+            f.write(b'\x89PNG\xff\xfe')
+
+        def detect(context):
+            with context.probe_binary_header('foobar.bin', 4, 'abcde') as h:
+                if h != b'\x89PNG':
+                    raise Exception
+
+        result = apply_format_detector(self._dataset_root, detect)
+
+        self.assertEqual(result, FormatDetectionConfidence.MEDIUM)
+
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_probe_binary_header_failure(self):
+        with open(osp.join(self._dataset_root, 'foobar.bin'), 'wb') as f:
+            f.write(b'GIF8')
+
+        def detect_bad_header(context):
+            with context.probe_binary_header('foobar.bin', 4, 'abcde') as h:
+                if h != b'\x89PNG':
+                    raise Exception
+
+        def detect_bad_file(context):
+            with context.probe_binary_header('foobaz.bin', 4, 'abcde'):
+                pass
+
+        for detect, path in [
+            (detect_bad_header, 'foobar.bin'),
+            (detect_bad_file, 'foobaz.bin'),
+        ]:
+            with self.subTest(path=path):
+                with self.assertRaises(FormatRequirementsUnmet) as result:
+                    apply_format_detector(self._dataset_root, detect)
+
+                self.assertEqual(result.exception.failed_alternatives,
+                    (f'{path}: abcde',))
+
     @mark_requirement(Requirements.DATUM_GENERAL_REQ)
     def test_require_any_success(self):
         alternatives_executed = set()
@@ -185,6 +404,58 @@ class FormatDetectionTest(TestCase):
         self.assertEqual(result, FormatDetectionConfidence.MEDIUM)
         self.assertEqual(alternatives_executed, {1, 2, 3})
 
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_require_any_nested(self):
+        with open(osp.join(self._dataset_root, 'foobar.txt'), 'w'):
+            pass
+
+        def detect(context):
+            with context.require_any():
+                with context.alternative():
+                    with context.require_any():
+                        with context.alternative():
+                            context.fail('bad alternative 1.1')
+                        with context.alternative():
+                            with context.probe_text_file(
+                                    'foobar.txt', 'abcde'):
+                                context.fail('bad alternative 1.2')
+                with context.alternative():
+                    context.require_file('*.dat')
+
+        with self.assertRaises(FormatRequirementsUnmet) as result:
+            apply_format_detector(self._dataset_root, detect)
+
+        self.assertEqual(len(result.exception.failed_alternatives), 3)
+        self.assertEqual(result.exception.failed_alternatives[:2],
+            ('bad alternative 1.1', 'bad alternative 1.2'))
+        self.assertIn('*.dat', result.exception.failed_alternatives[2])
+
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_require_any_short_circuit(self):
+        alternatives_executed = set()
+
+        def detect(context):
+            nonlocal alternatives_executed
+            with context.require_any(short_circuit=True):
+                with context.alternative():
+                    alternatives_executed.add(1)
+                    context.fail('bad alternative 1')
+                with context.alternative():
+                    alternatives_executed.add(2)
+                    # good alternative 2
+                with context.alternative():
+                    alternatives_executed.add(3)
+                    context.fail('bad alternative 3')
+
+            context.fail('requirement after require_any')
+
+        with self.assertRaises(FormatRequirementsUnmet) as result:
+            apply_format_detector(self._dataset_root, detect)
+
+        self.assertEqual(alternatives_executed, {1, 2})
+        self.assertEqual(result.exception.failed_alternatives,
+            ('requirement after require_any',))
+
     @mark_requirement(Requirements.DATUM_GENERAL_REQ)
     def test_require_any_failure(self):
         def detect(context):
@@ -199,3 +470,62 @@ class FormatDetectionTest(TestCase):
 
         self.assertEqual(result.exception.failed_alternatives,
             ('bad alternative 1', 'bad alternative 2'))
+
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_apply_many_detectors(self):
+        with open(osp.join(self._dataset_root, 'foobar.txt'), 'w'):
+            pass
+
+        def detect_a(context):
+            context.require_file('*.txt')
+
+        def detect_b(context):
+            context.require_file('*.dat')
+
+        for max_workers in [1, 2]:
+            with self.subTest(max_workers=max_workers):
+                results = apply_format_detectors(self._dataset_root, {
+                    'a': detect_a,
+                    'b': detect_b,
+                    'c': lambda context: FormatDetectionConfidence.LOW,
+                }, max_workers=max_workers)
+
+                self.assertEqual(list(results), ['a', 'b', 'c'])
+                self.assertEqual(results['a'],
+                    FormatDetectionConfidence.MEDIUM)
+                self.assertIsInstance(results['b'], FormatRequirementsUnmet)
+                self.assertEqual(results['c'], FormatDetectionConfidence.LOW)
+
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_contexts_are_not_shared(self):
+        context_a = FormatDetectionContext(self._dataset_root)
+        context_b = FormatDetectionContext(self._dataset_root)
+
+        self.assertIsInstance(context_a, FormatDetectionContext)
+        self.assertIsNot(context_a, context_b)
+
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_apply_many_detectors_in_threads(self):
+        with open(osp.join(self._dataset_root, 'foobar.txt'), 'w'):
+            pass
+
+        def detect(context):
+            for _ in range(100):
+                with context.require_any():
+                    # let other threads run inside the block
+                    time.sleep(0)
+
+                    with context.alternative():
+                        context.require_file('*.dat')
+                    with context.alternative():
+                        context.require_file('*.txt')
+
+        detectors = { str(i): detect for i in range(16) }
+
+        for _ in range(5):
+            results = apply_format_detectors(self._dataset_root, detectors,
+                max_workers=4)
+
+            self.assertEqual(results, {
+                name: FormatDetectionConfidence.MEDIUM for name in detectors
+            })
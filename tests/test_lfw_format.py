@@ -1,4 +1,5 @@
-from unittest import TestCase
+from functools import partial
+from unittest import TestCase, mock
 import os
 import os.path as osp
 import shutil
@@ -11,36 +12,47 @@ from datumaro.components.environment import Environment
 from datumaro.components.extractor import DatasetItem
 from datumaro.components.media import Image
 from datumaro.plugins.lfw_format import LfwConverter, LfwImporter
-from datumaro.util.test_utils import TestDir, compare_datasets
+from datumaro.util.test_utils import (
+    TestDir, compare_datasets, test_save_and_load,
+)
 
 from .requirements import Requirements, mark_requirement
 
 
 class LfwFormatTest(TestCase):
+    # The tests don't modify image data, so the same array can be shared
+    _IMAGE = np.ones((2, 5, 3))
+
+    def _test_save_and_load(self, source_dataset, converter, test_dir,
+            target_dataset=None, importer_args=None, **kwargs):
+        return test_save_and_load(self, source_dataset, converter, test_dir,
+            importer='lfw',
+            target_dataset=target_dataset, importer_args=importer_args, **kwargs)
+
     @mark_requirement(Requirements.DATUM_GENERAL_REQ)
     def test_can_save_and_load(self):
         source_dataset = Dataset.from_iterable([
             DatasetItem(id='name0_0001', subset='test',
-                image=np.ones((2, 5, 3)),
+                image=self._IMAGE,
                 annotations=[Label(0, attributes={
                     'positive_pairs': ['name0/name0_0002']
                 })]
             ),
             DatasetItem(id='name0_0002', subset='test',
-                image=np.ones((2, 5, 3)),
+                image=self._IMAGE,
                 annotations=[Label(0, attributes={
                     'positive_pairs': ['name0/name0_0001'],
                     'negative_pairs': ['name1/name1_0001']
                 })]
             ),
             DatasetItem(id='name1_0001', subset='test',
-                image=np.ones((2, 5, 3)),
+                image=self._IMAGE,
                 annotations=[Label(1, attributes={
                     'positive_pairs': ['name1/name1_0002']
                 })]
             ),
             DatasetItem(id='name1_0002', subset='test',
-                image=np.ones((2, 5, 3)),
+                image=self._IMAGE,
                 annotations=[Label(1, attributes={
                     'positive_pairs': ['name1/name1_0002'],
                     'negative_pairs': ['name0/name0_0001']
@@ -49,47 +61,41 @@ class LfwFormatTest(TestCase):
         ], categories=['name0', 'name1'])
 
         with TestDir() as test_dir:
-            LfwConverter.convert(source_dataset, test_dir,
-                save_images=True)
-            parsed_dataset = Dataset.import_from(test_dir, 'lfw')
-
-            compare_datasets(self, source_dataset, parsed_dataset,
+            self._test_save_and_load(source_dataset,
+                partial(LfwConverter.convert, save_images=True), test_dir,
                 require_images=True)
 
     @mark_requirement(Requirements.DATUM_GENERAL_REQ)
     def test_can_save_and_load_with_no_save_images(self):
         source_dataset = Dataset.from_iterable([
             DatasetItem(id='name0_0001', subset='test',
-                image=np.ones((2, 5, 3)),
+                image=self._IMAGE,
                 annotations=[Label(0, attributes={
                     'positive_pairs': ['name0/name0_0002']
                 })]
             ),
             DatasetItem(id='name0_0002', subset='test',
-                image=np.ones((2, 5, 3)),
+                image=self._IMAGE,
                 annotations=[Label(0, attributes={
                     'positive_pairs': ['name0/name0_0001'],
                     'negative_pairs': ['name1/name1_0001']
                 })]
             ),
             DatasetItem(id='name1_0001', subset='test',
-                image=np.ones((2, 5, 3)),
+                image=self._IMAGE,
                 annotations=[Label(1, attributes={})]
             ),
         ], categories=['name0', 'name1'])
 
         with TestDir() as test_dir:
-            LfwConverter.convert(source_dataset, test_dir,
-                save_images=False)
-            parsed_dataset = Dataset.import_from(test_dir, 'lfw')
-
-            compare_datasets(self, source_dataset, parsed_dataset)
+            self._test_save_and_load(source_dataset,
+                partial(LfwConverter.convert, save_images=False), test_dir)
 
     @mark_requirement(Requirements.DATUM_GENERAL_REQ)
     def test_can_save_and_load_with_landmarks(self):
         source_dataset = Dataset.from_iterable([
             DatasetItem(id='name0_0001',
-                subset='test', image=np.ones((2, 5, 3)),
+                subset='test', image=self._IMAGE,
                 annotations=[
                     Label(0, attributes={
                         'positive_pairs': ['name0/name0_0002']
@@ -98,7 +104,7 @@ class LfwFormatTest(TestCase):
                 ]
             ),
             DatasetItem(id='name0_0002',
-                subset='test', image=np.ones((2, 5, 3)),
+                subset='test', image=self._IMAGE,
                 annotations=[
                     Label(0),
                     Points([0, 5, 3, 5, 2, 2, 1, 0, 3, 0], label=0),
@@ -107,69 +113,66 @@ class LfwFormatTest(TestCase):
         ], categories=['name0'])
 
         with TestDir() as test_dir:
-            LfwConverter.convert(source_dataset, test_dir, save_images=True)
-            parsed_dataset = Dataset.import_from(test_dir, 'lfw')
-
-            compare_datasets(self, source_dataset, parsed_dataset)
+            self._test_save_and_load(source_dataset,
+                partial(LfwConverter.convert, save_images=True), test_dir,
+                require_images=True)
 
     @mark_requirement(Requirements.DATUM_GENERAL_REQ)
     def test_can_save_and_load_with_no_subsets(self):
         source_dataset = Dataset.from_iterable([
             DatasetItem(id='name0_0001',
-                image=np.ones((2, 5, 3)),
+                image=self._IMAGE,
                 annotations=[Label(0, attributes={
                     'positive_pairs': ['name0/name0_0002']
                 })],
             ),
             DatasetItem(id='name0_0002',
-                image=np.ones((2, 5, 3)),
+                image=self._IMAGE,
                 annotations=[Label(0)]
             ),
         ], categories=['name0'])
 
         with TestDir() as test_dir:
-            LfwConverter.convert(source_dataset, test_dir, save_images=True)
-            parsed_dataset = Dataset.import_from(test_dir, 'lfw')
-
-            compare_datasets(self, source_dataset, parsed_dataset)
+            self._test_save_and_load(source_dataset,
+                partial(LfwConverter.convert, save_images=True), test_dir,
+                require_images=True)
 
     @mark_requirement(Requirements.DATUM_GENERAL_REQ)
     def test_can_save_and_load_with_no_format_names(self):
         source_dataset = Dataset.from_iterable([
             DatasetItem(id='a/1',
-                image=np.ones((2, 5, 3)),
+                image=self._IMAGE,
                 annotations=[Label(0, attributes={
                     'positive_pairs': ['name0/b/2'],
                     'negative_pairs': ['d/4']
                 })],
             ),
             DatasetItem(id='b/2',
-                image=np.ones((2, 5, 3)),
+                image=self._IMAGE,
                 annotations=[Label(0)]
             ),
             DatasetItem(id='c/3',
-                image=np.ones((2, 5, 3)),
+                image=self._IMAGE,
                 annotations=[Label(1)]
             ),
             DatasetItem(id='d/4',
-                image=np.ones((2, 5, 3)),
+                image=self._IMAGE,
             ),
         ], categories=['name0', 'name1'])
 
         with TestDir() as test_dir:
-            LfwConverter.convert(source_dataset, test_dir, save_images=True)
-            parsed_dataset = Dataset.import_from(test_dir, 'lfw')
-
-            compare_datasets(self, source_dataset, parsed_dataset)
+            self._test_save_and_load(source_dataset,
+                partial(LfwConverter.convert, save_images=True), test_dir,
+                require_images=True)
 
     @mark_requirement(Requirements.DATUM_GENERAL_REQ)
     def test_can_save_dataset_with_cyrillic_and_spaces_in_filename(self):
         dataset = Dataset.from_iterable([
             DatasetItem(id='кириллица с пробелом',
-                image=np.ones((2, 5, 3))
+                image=self._IMAGE
             ),
             DatasetItem(id='name0_0002',
-                image=np.ones((2, 5, 3)),
+                image=self._IMAGE,
                 annotations=[Label(0, attributes={
                     'negative_pairs': ['кириллица с пробелом']
                 })]
@@ -177,10 +180,9 @@ class LfwFormatTest(TestCase):
         ], categories=['name0'])
 
         with TestDir() as test_dir:
-            LfwConverter.convert(dataset, test_dir, save_images=True)
-            parsed_dataset = Dataset.import_from(test_dir, 'lfw')
-
-            compare_datasets(self, dataset, parsed_dataset, require_images=True)
+            self._test_save_and_load(dataset,
+                partial(LfwConverter.convert, save_images=True), test_dir,
+                require_images=True)
 
     @mark_requirement(Requirements.DATUM_GENERAL_REQ)
     def test_can_save_and_load_image_with_arbitrary_extension(self):
@@ -196,90 +198,93 @@ class LfwFormatTest(TestCase):
         ], categories=['name0', 'name1'])
 
         with TestDir() as test_dir:
-            LfwConverter.convert(dataset, test_dir, save_images=True)
-            parsed_dataset = Dataset.import_from(test_dir, 'lfw')
-
-            compare_datasets(self, dataset, parsed_dataset, require_images=True)
+            self._test_save_and_load(dataset,
+                partial(LfwConverter.convert, save_images=True), test_dir,
+                require_images=True)
 
 DUMMY_DATASET_DIR = osp.join(osp.dirname(__file__), 'assets', 'lfw_dataset')
 
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError: # e.g. different file systems
+        shutil.copy2(src, dst)
+
 class LfwImporterTest(TestCase):
-    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
-    def test_can_detect(self):
-        detected_formats = Environment().detect_dataset(DUMMY_DATASET_DIR)
-        self.assertEqual([LfwImporter.NAME], detected_formats)
+    _IMAGE = np.ones((2, 5, 3))
 
-    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
-    def test_can_import(self):
-        expected_dataset = Dataset.from_iterable([
+    @classmethod
+    def _make_expected_dataset(cls, labels):
+        name0 = labels.index('name0')
+        name1 = labels.index('name1')
+
+        return Dataset.from_iterable([
             DatasetItem(id='name0_0001', subset='test',
-                image=np.ones((2, 5, 3)),
+                image=cls._IMAGE,
                 annotations=[
-                    Label(0, attributes={
+                    Label(name0, attributes={
                         'negative_pairs': ['name1/name1_0001',
                             'name1/name1_0002']
                     }),
-                    Points([0, 4, 3, 3, 2, 2, 1, 0, 3, 0], label=0),
+                    Points([0, 4, 3, 3, 2, 2, 1, 0, 3, 0], label=name0),
                 ]
             ),
             DatasetItem(id='name1_0001', subset='test',
-                image=np.ones((2, 5, 3)),
+                image=cls._IMAGE,
                 annotations=[
-                    Label(1, attributes={
+                    Label(name1, attributes={
                         'positive_pairs': ['name1/name1_0002'],
                     }),
-                    Points([1, 6, 4, 6, 3, 3, 2, 1, 4, 1], label=1),
+                    Points([1, 6, 4, 6, 3, 3, 2, 1, 4, 1], label=name1),
                 ]
             ),
             DatasetItem(id='name1_0002', subset='test',
-                image=np.ones((2, 5, 3)),
+                image=cls._IMAGE,
                 annotations=[
-                    Label(1),
-                    Points([0, 5, 3, 5, 2, 2, 1, 0, 3, 0], label=1),
+                    Label(name1),
+                    Points([0, 5, 3, 5, 2, 2, 1, 0, 3, 0], label=name1),
                 ]
             ),
-        ], categories=['name0', 'name1'])
+        ], categories=labels)
+
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_can_detect(self):
+        detected_formats = Environment().detect_dataset(DUMMY_DATASET_DIR)
+        self.assertEqual([LfwImporter.NAME], detected_formats)
+
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_can_import(self):
+        expected_dataset = self._make_expected_dataset(['name0', 'name1'])
 
         dataset = Dataset.import_from(DUMMY_DATASET_DIR, 'lfw')
 
         compare_datasets(self, expected_dataset, dataset)
 
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_can_import_without_loading_images(self):
+        with mock.patch.object(Image, 'data',
+                new_callable=mock.PropertyMock) as image_data:
+            dataset = Dataset.import_from(DUMMY_DATASET_DIR, 'lfw')
+
+            for item in dataset:
+                self.assertTrue(osp.isfile(item.image.path), item.id)
+
+        image_data.assert_not_called()
+
     @mark_requirement(Requirements.DATUM_GENERAL_REQ)
     def test_can_import_without_people_file(self):
-        expected_dataset = Dataset.from_iterable([
-            DatasetItem(id='name0_0001', subset='test',
-                image=np.ones((2, 5, 3)),
-                annotations=[
-                    Label(0, attributes={
-                        'negative_pairs': ['name1/name1_0001',
-                            'name1/name1_0002']
-                    }),
-                    Points([0, 4, 3, 3, 2, 2, 1, 0, 3, 0], label=0),
-                ]
-            ),
-            DatasetItem(id='name1_0001', subset='test',
-                image=np.ones((2, 5, 3)),
-                annotations=[
-                    Label(1, attributes={
-                        'positive_pairs': ['name1/name1_0002'],
-                    }),
-                    Points([1, 6, 4, 6, 3, 3, 2, 1, 4, 1], label=1),
-                ]
-            ),
-            DatasetItem(id='name1_0002', subset='test',
-                image=np.ones((2, 5, 3)),
-                annotations=[
-                    Label(1),
-                    Points([0, 5, 3, 5, 2, 2, 1, 0, 3, 0], label=1),
-                ]
-            ),
-        ], categories=['name0', 'name1'])
+        # Without the people file, labels are added in the order
+        # they appear in the pairs file
+        expected_dataset = self._make_expected_dataset(['name1', 'name0'])
 
         with TestDir() as test_dir:
             dataset_path = osp.join(test_dir, 'dataset')
-            shutil.copytree(DUMMY_DATASET_DIR, dataset_path)
+            # The files are only removed from the copy, so they can be
+            # shared with the original dataset
+            shutil.copytree(DUMMY_DATASET_DIR, dataset_path,
+                copy_function=_link_or_copy)
             os.remove(osp.join(dataset_path, 'test', 'annotations', 'people.txt'))
 
-            dataset = Dataset.import_from(DUMMY_DATASET_DIR, 'lfw')
+            dataset = Dataset.import_from(dataset_path, 'lfw')
 
             compare_datasets(self, expected_dataset, dataset)
@@ -2,10 +2,11 @@ from unittest import TestCase
 import logging as log
 
 import numpy as np
+import pycocotools.mask as mask_utils
 
 from datumaro.components.annotation import (
     AnnotationType, Bbox, Label, LabelCategories, Mask, MaskCategories, Points,
-    PointsCategories, Polygon, PolyLine,
+    PointsCategories, Polygon, PolyLine, RleMask,
 )
 from datumaro.components.extractor import DatasetItem
 from datumaro.components.project import Dataset
@@ -146,6 +147,38 @@ class TransformsTest(TestCase):
         actual = transforms.CropCoveredSegments(source_dataset)
         compare_datasets(self, target_dataset, actual)
 
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_crop_covered_segments_with_rle_masks(self):
+        source_dataset = Dataset.from_iterable([
+            DatasetItem(id=1, image=np.zeros((5, 5, 3)), annotations=[
+                # The mask is partially covered by the polygon
+                RleMask(mask_utils.encode(np.asfortranarray(np.array([
+                        [0, 0, 1, 1, 1],
+                        [0, 0, 1, 1, 1],
+                        [1, 1, 1, 1, 1],
+                        [1, 1, 1, 0, 0],
+                        [1, 1, 1, 0, 0]],
+                    dtype=np.uint8))), z_order=0),
+                Polygon([1, 1, 4, 1, 4, 4, 1, 4], z_order=1),
+            ]),
+        ])
+
+        target_dataset = Dataset.from_iterable([
+            DatasetItem(id=1, image=np.zeros((5, 5, 3)), annotations=[
+                Mask(np.array([
+                        [0, 0, 1, 1, 1],
+                        [0, 0, 0, 0, 1],
+                        [1, 0, 0, 0, 1],
+                        [1, 0, 0, 0, 0],
+                        [1, 1, 1, 0, 0]],
+                    ), z_order=0),
+                Polygon([1, 1, 4, 1, 4, 4, 1, 4], z_order=1),
+            ]),
+        ])
+
+        actual = transforms.CropCoveredSegments(source_dataset)
+        compare_datasets(self, target_dataset, actual)
+
     @mark_requirement(Requirements.DATUM_GENERAL_REQ)
     def test_merge_instance_segments(self):
         source_dataset = Dataset.from_iterable([
@@ -194,6 +227,25 @@ class TransformsTest(TestCase):
             include_polygons=True)
         compare_datasets(self, target_dataset, actual)
 
+    @mark_requirement(Requirements.DATUM_GENERAL_REQ)
+    def test_merge_instance_segments_uses_overridden_find_instances(self):
+        class KeepSegmentsSeparate(transforms.MergeInstanceSegments):
+            @staticmethod
+            def find_instances(annotations):
+                return [[a] for a in annotations]
+
+        source_dataset = Dataset.from_iterable([
+            DatasetItem(id=1, image=np.zeros((5, 5, 3)),
+                annotations=[
+                    Mask(np.array([[0, 0, 1, 1, 1]] * 5), group=1),
+                    Mask(np.array([[1, 1, 0, 0, 0]] * 5), group=1),
+                ]
+            ),
+        ])
+
+        actual = KeepSegmentsSeparate(source_dataset)
+        compare_datasets(self, source_dataset, actual)
+
     @mark_requirement(Requirements.DATUM_GENERAL_REQ)
     def test_map_subsets(self):
         source_dataset = Dataset.from_iterable([